@@ -2,15 +2,18 @@
 # -*- coding: utf-8 -*-
 from __future__ import absolute_import
 from hashlib import sha1
-from copy import deepcopy
 from datetime import datetime, timedelta
 from pytz import timezone
 import json
 import logging
 import os
+import zlib
 
-from .cache import CUPS_CACHE, CUPS_UUIDS
-from .utils import recursive_update, reduce_history, is_tertiary
+from .cache import CUPS_CACHE, CUPS_UUIDS, REFERENCE_CACHE
+from .utils import (
+    recursive_update, reduce_history, is_tertiary, LRUCache, read_by_id, chunks,
+    config_from_environment, setup_redis
+)
 from empowering.utils import remove_none, make_uuid, make_utc_timestamp
 
 
@@ -21,7 +24,45 @@ COLLECTION_UNITS = {
     'tg.f1': 'kWh'
 }
 
-TZ = timezone('Europe/Madrid')
+
+
+def setup_converter(**kwargs):
+    """Converter settings, can be overridden with CONVERTER_* environment vars.
+
+    CUPS_20_CHARACTERS is still honoured for the truncation of the CUPS.
+    """
+    config = {
+        'cups_20_characters': int(os.getenv('CUPS_20_CHARACTERS', '0')),
+        'timezone': 'Europe/Madrid',
+        'units': UNITS,
+        'collection_units': COLLECTION_UNITS
+    }
+    config.update(kwargs)
+    return config_from_environment('CONVERTER', **config)
+
+
+# Built once per process, default of the converters without a config
+CONVERTER_CONFIG = setup_converter()
+
+PROFILE_FIELDS = ['name', 'datetime', 'ai']
+
+# Fields of the ERP models, kept for the whole life of the process
+FIELDS_CACHE = {}
+
+# Minimum number of profiles to use the vectorized conversion
+VECTORIZE_MIN_PROFILES = 1000
+
+# Local to UTC conversions, shared by all the converters of the process and
+# keyed by timezone
+UTC_TIMESTAMPS = LRUCache(maxsize=100000)
+
+# make_uuid results, shared by all the converters of the process and
+# optionally persisted in Redis (UUIDCACHE_REDIS)
+UUIDS_CONFIG = config_from_environment(
+    'UUIDCACHE', maxsize=100000, redis=False
+)
+UUIDS = LRUCache(maxsize=UUIDS_CONFIG['maxsize'])
+UUIDS_REDIS_KEY = 'amoniak:uuids'
 
 logger = logging.getLogger('amon')
 
@@ -51,58 +92,251 @@ def get_street_name(cups):
     return street_name
 
 
-def map_datetime(raw_timestamp):
+def encode_profiles(profiles):
+    """Encode profiles read with `PROFILE_FIELDS` into a compact payload.
+    """
+    rows = [[profile[f] for f in PROFILE_FIELDS] for profile in profiles]
+    return zlib.compress(json.dumps(rows, separators=(',', ':')))
+
+
+def decode_profiles(payload):
+    """Decode a payload built with `encode_profiles` into profiles dicts.
+    """
+    rows = json.loads(zlib.decompress(payload))
+    return [dict(zip(PROFILE_FIELDS, row)) for row in rows]
+
+
+def vectorized_utc_timestamps(datetimes, tz=None):
+    """Convert a pandas Series of local datetimes of `tz` to UTC AMON
+    timestamps.
+
+    The UTC offset is computed with `make_utc_timestamp` once per day and
+    applied to all the hours of the day at once. Days with a DST change and
+    values that can't be parsed are converted one by one, so the result is
+    the same as calling `make_utc_timestamp` for every value.
+    """
+    import numpy as np
+    import pandas as pd
+    tz = tz or CONVERTER_CONFIG['timezone']
+    local_tz = timezone(tz)
+    local = pd.to_datetime(datetimes, format='%Y-%m-%d %H:%M:%S', errors='coerce')
+    days = datetimes.str[:10]
+    offsets = {}
+    for day in days.unique():
+        try:
+            start = local_tz.localize(datetime.strptime(day, '%Y-%m-%d'))
+        except (TypeError, ValueError):
+            offsets[day] = None
+            continue
+        end = local_tz.localize(start.replace(tzinfo=None) + timedelta(hours=23))
+        if start.utcoffset() != end.utcoffset():
+            offsets[day] = None
+            continue
+        noon = start.replace(tzinfo=None) + timedelta(hours=12)
+        utc_noon = datetime.strptime(
+            utc_timestamp(noon.strftime('%Y-%m-%d %H:%M:%S'), tz),
+            '%Y-%m-%dT%H:%M:%SZ'
+        )
+        offsets[day] = noon - utc_noon
+    offsets = days.map(offsets)
+    exact = (offsets.isnull() | local.isnull()).values
+    utc = local[~exact] - pd.to_timedelta(offsets[~exact])
+    # Filled by position, whatever the index of `datetimes` is
+    result = [None] * len(datetimes)
+    for pos, value in zip(np.flatnonzero(~exact),
+                          utc.dt.strftime('%Y-%m-%dT%H:%M:%SZ')):
+        result[pos] = value
+    for pos, value in zip(np.flatnonzero(exact), datetimes.values[exact]):
+        result[pos] = utc_timestamp(value, tz)
+    return result
+
+
+def utc_timestamp(timestamp, tz=None):
+    """Cached version of `make_utc_timestamp` for local timestamp strings.
+
+    The conversion only depends on the string and the timezone (the one of
+    `CONVERTER_CONFIG` by default), so ambiguous DST hours are resolved the
+    same way as `make_utc_timestamp` does.
+    """
+    tz = tz or CONVERTER_CONFIG['timezone']
+    if not timestamp or not isinstance(timestamp, basestring):
+        return make_utc_timestamp(timestamp, tz)
+    return UTC_TIMESTAMPS.get_or_set(
+        (tz, timestamp), make_utc_timestamp, timestamp, tz
+    )
+
+
+def utc_timestamps_info():
+    """Return the hits/misses counters of the UTC timestamps cache.
+    """
+    return UTC_TIMESTAMPS.info()
+
+
+def model_uuid(model, key):
+    """Cached version of `make_uuid`.
+    """
+    return UUIDS.get_or_set((model, key), make_uuid, model, key)
+
+
+def prefetch_uuids(model, keys):
+    """Load the uuids of `keys` of `model` in the process cache.
+
+    With the Redis tier enabled the ones not in the process cache are read
+    with one ``HMGET`` and the ones not in Redis are computed and stored
+    there. Without it they are just computed.
+    """
+    missing = [key for key in set(keys) if (model, key) not in UUIDS]
+    if not missing:
+        return
+    if not UUIDS_CONFIG['redis']:
+        for key in missing:
+            model_uuid(model, key)
+        return
+    conn = setup_redis()
+    fields = ['{},{}'.format(model, key) for key in missing]
+    new = {}
+    for key, field, value in zip(missing, fields,
+                                 conn.hmget(UUIDS_REDIS_KEY, fields)):
+        if value is None:
+            value = make_uuid(model, key)
+            new[field] = value
+        UUIDS.set((model, key), value)
+    if new:
+        conn.hmset(UUIDS_REDIS_KEY, new)
+
+
+def uuids_info():
+    """Return the hits/misses counters of the uuids cache.
+    """
+    return UUIDS.info()
+
+
+def _map_datetime(raw_timestamp, tz):
+    local_tz = timezone(tz)
     date, nhour = raw_timestamp.split(' ')
-    current_date = TZ.localize(datetime.strptime(date, '%Y-%m-%d'))
-    current_date = TZ.normalize(current_date + timedelta(hours=int(nhour)))
-    return make_utc_timestamp(current_date)
+    current_date = local_tz.localize(datetime.strptime(date, '%Y-%m-%d'))
+    current_date = local_tz.normalize(
+        current_date + timedelta(hours=int(nhour))
+    )
+    return make_utc_timestamp(current_date, tz)
+
+
+def map_datetime(raw_timestamp, tz=None):
+    """Convert a ``YYYY-MM-DD H`` timestamp of `tz`, where H is the number
+    of hours from the start of the day, to UTC.
+
+    Counting hours from midnight keeps the DST changing hours apart.
+    """
+    tz = tz or CONVERTER_CONFIG['timezone']
+    return UTC_TIMESTAMPS.get_or_set(
+        ('hours', tz, raw_timestamp), _map_datetime, raw_timestamp, tz
+    )
 
 
 
 class AmonConverter(object):
-    def __init__(self, connection):
+    def __init__(self, connection, config=None):
         self.O = connection
+        self.config = config or CONVERTER_CONFIG
+
+    def utc_timestamp(self, timestamp):
+        """`utc_timestamp` in the timezone of the converter."""
+        return utc_timestamp(timestamp, self.config['timezone'])
+
+    def get_fields(self, model):
+        """Return the fields names of `model` (``GiscedataCupsPs`` style).
+
+        The result of ``fields_get`` is cached in `FIELDS_CACHE`.
+        """
+        if model not in FIELDS_CACHE:
+            FIELDS_CACHE[model] = set(getattr(self.O, model).fields_get())
+        return FIELDS_CACHE[model]
 
     def get_cups_from_device(self, serial):
+        return self.get_cups_from_devices([serial]).get(serial, False)
+
+    def get_cups_from_devices(self, serials):
+        """Return a dict meter serial -> CUPS uuid for `serials`.
+
+        Serials not found in the index are resolved with one read of the
+        meters and are added to it.
+        """
+        result = CUPS_CACHE.get_many(serials)
+        missing = [s for s in set(serials) if s not in result]
+        if missing:
+            result.update(self.index_cups_devices([
+                ('name', 'in', missing)
+            ]))
+        return result
+
+    def index_cups_devices(self, search_params=None, chunk=5000):
+        """Add the meters matching `search_params` to the CUPS index.
+
+        Without `search_params` all the meters are indexed.
+        """
         O = self.O
-        # Remove brand prefix and right zeros
-        if serial in CUPS_CACHE:
-            return CUPS_CACHE[serial]
-        else:
-            # Search de meter
-            cid = O.GiscedataLecturesComptador.search([
-                ('name', '=', serial)
-            ], context={'active_test': False})
-            if not cid:
-                res = False
-            else:
-                cid = O.GiscedataLecturesComptador.browse(cid[0])
-                res = make_uuid('giscedata.cups.ps', cid.polissa.cups.name)
-                CUPS_UUIDS[res] = cid.polissa.cups.id
-                CUPS_CACHE[serial] = res
-            return res
+        comptador_obj = O.GiscedataLecturesComptador
+        ids = comptador_obj.search(
+            search_params or [], context={'active_test': False}
+        )
+        serials = {}
+        for ids_chunk in chunks(ids, chunk):
+            comptadors = read_by_id(comptador_obj, ids_chunk, ['name', 'polissa'])
+            polisses = read_by_id(O.GiscedataPolissa, [
+                c['polissa'][0] for c in comptadors.values() if c['polissa']
+            ], ['cups'])
+            cups_list = read_by_id(O.GiscedataCupsPs, [
+                p['cups'][0] for p in polisses.values() if p['cups']
+            ], ['name'])
+            uuids = {}
+            # Keep the first meter found for every serial as the search does
+            for comptador_id in ids_chunk:
+                comptador = comptadors[comptador_id]
+                if comptador['name'] in serials or not comptador['polissa']:
+                    continue
+                polissa = polisses[comptador['polissa'][0]]
+                if not polissa['cups']:
+                    continue
+                cups = cups_list[polissa['cups'][0]]
+                res = model_uuid('giscedata.cups.ps', cups['name'])
+                serials[comptador['name']] = res
+                uuids[res] = cups['id']
+            CUPS_UUIDS.set_many(uuids)
+        CUPS_CACHE.set_many(serials)
+        return serials
 
     def tariff_to_amon(self, pricelist_id, tariff_id):
         c = self.O
-        tariff = c.GiscedataPolissaTarifa.read(tariff_id, ['name'])
-        pricelist = c.ProductPricelist.browse(pricelist_id)
-        uom_id = c.IrModelData.get_object_reference('giscedata_facturacio', 'uom_pot_elec_dia')[1]
+        tariff = REFERENCE_CACHE.get(
+            'giscedata.polissa.tarifa', tariff_id,
+            lambda: c.GiscedataPolissaTarifa.read(tariff_id, ['name'])
+        )
+        pricelist = REFERENCE_CACHE.get(
+            'product.pricelist', pricelist_id,
+            lambda: self.read_pricelist(pricelist_id)
+        )
+        uom_id = REFERENCE_CACHE.get(
+            'ir.model.data', 'giscedata_facturacio.uom_pot_elec_dia',
+            lambda: c.IrModelData.get_object_reference(
+                'giscedata_facturacio', 'uom_pot_elec_dia'
+            )[1]
+        )
         result = []
-        for v in pricelist.version_id:
-            date_start = v.date_start + ' 01:00:00'
-            if v.date_end:
-                date_end = (datetime.strptime(v.date_end, '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
+        for v in pricelist['versions']:
+            date_start = v['date_start'] + ' 01:00:00'
+            if v['date_end']:
+                date_end = (datetime.strptime(v['date_end'], '%Y-%m-%d') + timedelta(days=1)).strftime('%Y-%m-%d')
             else:
                 date_end = None
-            tariff_cost_id = '{} ({})'.format(pricelist.name, pricelist.currency_id.name)
+            tariff_cost_id = '{} ({})'.format(pricelist['name'], pricelist['currency'])
             tariff_name = tariff['name']
             price_date = date_start[:10]
             try:
                 vals = {
                     'tariffCostId': tariff_cost_id,
                     'tariffId': tariff_name,
-                    'dateStart': date_start and make_utc_timestamp(date_start),
-                    'dateEnd': date_end and make_utc_timestamp(date_end),
+                    'dateStart': date_start and self.utc_timestamp(date_start),
+                    'dateEnd': date_end and self.utc_timestamp(date_end),
                     'powerPrice': [round(v, 6) for k, v in sorted(c.GiscedataPolissaTarifa.get_periodes_preus(
                         tariff_id, 'tp', pricelist_id, {'date': price_date, 'uom': uom_id}
                     ).items())],
@@ -115,7 +349,7 @@ class AmonConverter(object):
                 logger.error(
                     "Error retrieving prices",
                     extra={'data': {
-                        'pricelist': (pricelist_id, pricelist.name),
+                        'pricelist': (pricelist_id, pricelist['name']),
                         'tariff': (tariff_id, tariff_name),
                         'date': price_date
                     }}
@@ -123,74 +357,141 @@ class AmonConverter(object):
                 continue
         return result
 
+    def read_pricelist(self, pricelist_id):
+        pricelist = self.O.ProductPricelist.browse(pricelist_id)
+        return {
+            'name': pricelist.name,
+            'currency': pricelist.currency_id.name,
+            'versions': [
+                {'date_start': v.date_start, 'date_end': v.date_end}
+                for v in pricelist.version_id
+            ]
+        }
+
     def profiles_to_amon(self, profiles, collection='tg.cchfact'):
         c = self.O
-        result = {}
-        # TODO: We need a hack to convert meter serial to CUPS uuid
-        # maybe we can have a global uuids cache pre-generated for that
-        uuids = {}
         model = c.model(collection)
-        for profile in model.read(profiles):
+        return self.profile_rows_to_amon(
+            model.read(profiles, PROFILE_FIELDS), collection
+        )
+
+    def profile_rows_to_amon(self, profiles, collection='tg.cchfact'):
+        """Converts already read profiles to AMON.
+
+        `profiles` is a list of dicts with at least `PROFILE_FIELDS`.
+        """
+        if len(profiles) >= VECTORIZE_MIN_PROFILES:
+            try:
+                return self.profile_rows_to_amon_vectorized(
+                    profiles, collection
+                )
+            except ImportError:
+                logger.debug('pandas not available, converting row by row')
+        result = {}
+        cups_20 = self.config['cups_20_characters']
+        unit = self.config['collection_units'][collection]
+        for profile in profiles:
             cups = profile['name']
             if len(cups) != 22:
                 cups = '{}0F'.format(cups)
             # Check if CUPS must be informed with 20 characters
-            if int(os.getenv('CUPS_20_CHARACTERS', '0')):
+            if cups_20:
                 cups = cups[:20]
-            m_point_id = uuids.get(cups)
-            if not m_point_id:
-                m_point_id = make_uuid('giscedata.cups.ps', cups)
-                uuids[cups] = m_point_id
-            result.setdefault(cups, {
-                "measurements": [],
-                "meteringPointId": m_point_id,
-                "readings": [
-                    {"type": "electricityConsumption", "period": "INSTANT",
-                     "unit": COLLECTION_UNITS[collection]},
-                ],
-                "deviceId": m_point_id
-            })
+            if cups not in result:
+                m_point_id = model_uuid('giscedata.cups.ps', cups)
+                result[cups] = {
+                    "measurements": [],
+                    "meteringPointId": m_point_id,
+                    "readings": [
+                        {"type": "electricityConsumption", "period": "INSTANT",
+                         "unit": unit},
+                    ],
+                    "deviceId": m_point_id
+                }
             result[cups]['measurements'] += [
                 {
-                    "timestamp": make_utc_timestamp(profile['datetime']),
+                    "timestamp": self.utc_timestamp(profile['datetime']),
                     "type": "electricityConsumption",
                     "value": profile['ai']
                 }
             ]
         return result
 
+    def profile_rows_to_amon_vectorized(self, profiles, collection='tg.cchfact'):
+        """Same as `profile_rows_to_amon` but converting columns with pandas.
+        """
+        import pandas as pd
+        names = pd.Series([profile['name'] for profile in profiles], dtype=object)
+        cups = names.where(names.str.len() == 22, names + '0F')
+        # Check if CUPS must be informed with 20 characters
+        if self.config['cups_20_characters']:
+            cups = cups.str[:20]
+        timestamps = vectorized_utc_timestamps(pd.Series(
+            [profile['datetime'] for profile in profiles], dtype=object
+        ), self.config['timezone'])
+        groups = cups.groupby(cups, sort=False).indices
+        prefetch_uuids('giscedata.cups.ps', groups.keys())
+        result = {}
+        for cups_name, positions in groups.items():
+            m_point_id = model_uuid('giscedata.cups.ps', cups_name)
+            result[cups_name] = {
+                "measurements": [
+                    {
+                        "timestamp": timestamps[idx],
+                        "type": "electricityConsumption",
+                        "value": profiles[idx]['ai']
+                    } for idx in positions
+                ],
+                "meteringPointId": m_point_id,
+                "readings": [
+                    {"type": "electricityConsumption", "period": "INSTANT",
+                     "unit": self.config['collection_units'][collection]},
+                ],
+                "deviceId": m_point_id
+            }
+        return result
+
     def aggregated_measures_to_amon(self, measures):
         res = {'R': [], 'T': []}
+        cups_20 = self.config['cups_20_characters']
+        prefetch_uuids('giscedata.cups.ps', [
+            cups_20 and m['cups'][:20] or m['cups'] for m in measures
+        ])
 
-        for m in deepcopy(measures):
+        # The input is not modified, so it doesn't need to be copied
+        for m in measures:
             values = {}
             cups = m['cups']
             # Check if CUPS must be informed with 20 characters
-            if int(os.getenv('CUPS_20_CHARACTERS', '0')):
+            if cups_20:
                 cups = cups[:20]
             for agg in m['measures']:
-                t = agg.pop('tipus')
+                t = agg['tipus']
                 values.setdefault(t, {})
-                values[t].update(agg)
+                values[t].update(
+                    (k, v) for k, v in agg.iteritems() if k != 'tipus'
+                )
 
+            timestamp = self.utc_timestamp(m['timestamp'])
+            residential = m['resource'] == 'R'
             measurements = {
                 'A': {
-                    'timestamp': make_utc_timestamp(m['timestamp']),
-                    'type': m['resource'] == 'R' and 'touElectricityConsumption' or 'tertiaryElectricityConsumption',
+                    'timestamp': timestamp,
+                    'type': residential and 'touElectricityConsumption' or 'tertiaryElectricityConsumption',
                     'values': values.get('A')
                 },
                 'R': {
-                    'timestamp': make_utc_timestamp(m['timestamp']),
-                    'type': m['resource'] == 'R' and 'touElectricityKiloVoltAmpHours' or 'tertiaryElectricityKiloVoltAmpHours',
+                    'timestamp': timestamp,
+                    'type': residential and 'touElectricityKiloVoltAmpHours' or 'tertiaryElectricityKiloVoltAmpHours',
                     'values': values.get('R')
                 },
                 'P': {
-                    'timestamp': make_utc_timestamp(m['timestamp']),
-                    'type': m['resource'] == 'R' and 'touPower' or 'tertiaryPower',
+                    'timestamp': timestamp,
+                    'type': residential and 'touPower' or 'tertiaryPower',
                     'values': values.get('P')
                 }
             }
-            deviceId = make_uuid('giscedata.cups.ps', cups)
+            deviceId = model_uuid('giscedata.cups.ps', cups)
             readings = []
             if measurements['A']['values']:
                 readings.append({
@@ -252,14 +553,15 @@ class AmonConverter(object):
         }
         """
         res = []
+        units = self.config['units']
         if not hasattr(measures, '__iter__'):
             measures = [measures]
 
         for measure in measures:
-            mp_uuid = make_uuid(
+            mp_uuid = model_uuid(
                 'giscedata.cups.ps', measure.comptador.polissa.cups.name
             )
-            device_uuid = make_uuid(
+            device_uuid = model_uuid(
                 'giscedata.lectures.comptador', measure.comptador.id
             )
             readings = []
@@ -267,14 +569,14 @@ class AmonConverter(object):
                 # measurements of 2.X
                 readings += [{
                     "type":  "touPower",
-                    "unit": "%sW" % UNITS[measure.get('magn', 1000)],
+                    "unit": "%sW" % units[measure.get('magn', 1000)],
                     "period": "INSTANT",
                 }]
             else:
                 # tertiaryMeasurements
                 readings += [{
                     "type": "tertiaryPower",
-                    "unit": "%sW" % UNITS[measure.get('magn', 1000)],
+                    "unit": "%sW" % units[measure.get('magn', 1000)],
                     "period": "INSTANT",
                 }]
 
@@ -285,7 +587,7 @@ class AmonConverter(object):
                 "measurements": [
                     {
                         "type": readings[0]["type"],
-                        "timestamp": make_utc_timestamp(measure.name),
+                        "timestamp": self.utc_timestamp(measure.name),
                         "values": {
                             measure.periode.name: float(measure.lectura)
                         }
@@ -328,14 +630,15 @@ class AmonConverter(object):
         }
         """
         res = []
+        units = self.config['units']
         if not hasattr(measures, '__iter__'):
             measures = [measures]
 
         for measure in measures:
-            mp_uuid = make_uuid(
+            mp_uuid = model_uuid(
                 'giscedata.cups.ps', measure.comptador.polissa.cups.name
             )
-            device_uuid = make_uuid(
+            device_uuid = model_uuid(
                 'giscedata.lectures.comptador', measure.comptador.id
             )
             readings = []
@@ -344,13 +647,13 @@ class AmonConverter(object):
                 if measure.tipus == 'A':
                     readings += [{
                         "type":  "touElectricityConsumption",
-                        "unit": "%sWh" % UNITS[measure.get('magn', 1000)],
+                        "unit": "%sWh" % units[measure.get('magn', 1000)],
                         "period": "INSTANT",
                     }]
                 elif measure.tipus == 'R':
                     readings += [{
                         "type": "touElectricityKiloVoltAmpHours",
-                        "unit": "%sVArh" % UNITS[measure.get('magn', 1000)],
+                        "unit": "%sVArh" % units[measure.get('magn', 1000)],
                         "period": "INSTANT",
                     }]
             else:
@@ -358,13 +661,13 @@ class AmonConverter(object):
                 if measure.tipus == 'A':
                     readings += [{
                         "type": "tertiaryElectricityConsumption",
-                        "unit": "%sWh" % UNITS[measure.get('magn', 1000)],
+                        "unit": "%sWh" % units[measure.get('magn', 1000)],
                         "period": "INSTANT",
                     }]
                 elif measure.tipus == 'R':
                     readings += [{
                         "type": "tertiaryElectricityKiloVoltAmpHours",
-                        "unit": "%sVArh" % UNITS[measure.get('magn', 1000)],
+                        "unit": "%sVArh" % units[measure.get('magn', 1000)],
                         "period": "INSTANT",
                     }]
 
@@ -375,7 +678,7 @@ class AmonConverter(object):
                 "measurements": [
                     {
                         "type": readings[0]["type"],
-                        "timestamp": make_utc_timestamp(measure.name),
+                        "timestamp": self.utc_timestamp(measure.name),
                         "value": float(measure.consum)
                     }
                 ]
@@ -385,6 +688,11 @@ class AmonConverter(object):
     def contract_to_amon(self, contract_ids, context=None):
         """Converts contracts to AMON.
 
+        The related records of all the contracts are read at once, but
+        ``get_potencies_dict`` of every contract modification and
+        ``get_empowering_custom_fields`` of every contract are still called
+        one by one: the ERP has no bulk version of them.
+
         {
           "payerId":"payerID-123",
           "ownerId":"ownerID-123",
@@ -430,6 +738,7 @@ class AmonConverter(object):
         pol = O.GiscedataPolissa
         partner = O.ResPartner
         modcon_obj = O.GiscedataPolissaModcontractual
+        compt_obj = O.GiscedataLecturesComptador
         if not hasattr(contract_ids, '__iter__'):
             contract_ids = [contract_ids]
         fields_to_read = [
@@ -438,11 +747,30 @@ class AmonConverter(object):
             'llista_preu', 'cnae', 'modcontractuals_ids', 'potencia',
             'coeficient_d', 'coeficient_k', 'mode_facturacio', 'potencies_periode'
         ]
-        for polissa in pol.read(contract_ids, fields_to_read):
-            if polissa['state'] in ('esborrany', 'validar'):
-                continue
+        polisses = [
+            polissa for polissa in pol.read(contract_ids, fields_to_read)
+            if polissa['state'] not in ('esborrany', 'validar')
+        ]
+        # Prefetch the related records of all the contracts at once
+        customers = read_by_id(
+            partner, [p['titular'][0] for p in polisses], ['lang']
+        )
+        modcon_fields = [
+            'data_inici', 'data_final', 'llista_preu', 'tarifa', 'potencia',
+            'mode_facturacio', 'coeficient_d', 'coeficient_k'
+        ]
+        modcons = read_by_id(modcon_obj, [
+            m_id for p in polisses for m_id in p['modcontractuals_ids']
+        ], modcon_fields)
+        comptadors = read_by_id(compt_obj, [
+            c_id for p in polisses for c_id in p['comptadors']
+        ], ['data_alta', 'data_baixa'])
+        cups_amon = self.cups_list_to_amon([p['cups'][0] for p in polisses])
+        potencies = self.read_potencies(polisses)
+        cups_20 = self.config['cups_20_characters']
+        for polissa in polisses:
             tarifa_atr = polissa['tarifa'][1]
-            customer = partner.read(polissa['titular'][0], ['lang'])
+            customer = customers[polissa['titular'][0]]
             if polissa['mode_facturacio'] == 'index':
                 fee = polissa['coeficient_d'] + polissa['coeficient_k']
                 tariff_cost_id = '{} - {}'.format(polissa['llista_preu'][1], fee)
@@ -450,26 +778,26 @@ class AmonConverter(object):
                 tariff_cost_id = polissa['llista_preu'][1]
             cups = polissa['cups'][1]
             # Check if CUPS must be informed with 20 characters
-            if int(os.getenv('CUPS_20_CHARACTERS', '0')):
+            if cups_20:
                 cups = cups[:20]
             contract = {
                 'contractId': polissa['name'],
-                'ownerId': make_uuid('res.partner', polissa['titular'][0]),
-                'payerId': make_uuid('res.partner', polissa['pagador'][0]),
-                'signerId': make_uuid('res.partner', polissa['pagador'][0]),
+                'ownerId': model_uuid('res.partner', polissa['titular'][0]),
+                'payerId': model_uuid('res.partner', polissa['pagador'][0]),
+                'signerId': model_uuid('res.partner', polissa['pagador'][0]),
                 'power': int(polissa['potencia'] * 1000),
-                'dateStart': make_utc_timestamp(polissa['data_alta']),
-                'dateEnd': make_utc_timestamp(polissa['data_baixa']),
+                'dateStart': self.utc_timestamp(polissa['data_alta']),
+                'dateEnd': self.utc_timestamp(polissa['data_baixa']),
                 'tariffId': tarifa_atr,
                 'tariffCostId': tariff_cost_id,
                 'version': int(polissa['modcontractual_activa'][1]),
                 'activityCode': polissa['cnae'] and polissa['cnae'][1].split(' ')[0] or None,
                 'customer': {
-                    'customerId': make_uuid('res.partner', polissa['titular'][0]),
+                    'customerId': model_uuid('res.partner', polissa['titular'][0]),
                 },
-                'devices': self.device_to_amon(
-                    polissa['comptadors'],
-                    force_serial=make_uuid('giscedata.cups.ps', cups)
+                'devices': self.comptadors_to_amon(
+                    [comptadors[c_id] for c_id in sorted(set(polissa['comptadors']))],
+                    force_serial=model_uuid('giscedata.cups.ps', cups)
                 ),
                 'report': {
                     'language': customer['lang'] or 'ca_ES'
@@ -484,12 +812,9 @@ class AmonConverter(object):
             ]
             for k, _ in history_fields:
                 contract[k] = []
-            modcon_fields = [
-                'data_inici', 'data_final', 'llista_preu', 'tarifa', 'potencia',
-                'mode_facturacio', 'coeficient_d', 'coeficient_k'
-            ]
             mcon_activa = polissa['modcontractual_activa'][0]
-            for modcon in O.GiscedataPolissaModcontractual.read(polissa['modcontractuals_ids'], modcon_fields):
+            for modcon_id in sorted(set(polissa['modcontractuals_ids'])):
+                modcon = modcons[modcon_id]
                 mod_tarifa_atr = modcon['tarifa'][1]
 
                 if modcon['mode_facturacio'] == 'index':
@@ -499,28 +824,28 @@ class AmonConverter(object):
                     tariff_cost_id = modcon['llista_preu'][1]
 
                 contract['tariffCostHistory'].append({
-                    'dateStart': make_utc_timestamp(modcon['data_inici']),
-                    'dateEnd': make_utc_timestamp(modcon['data_final']),
+                    'dateStart': self.utc_timestamp(modcon['data_inici']),
+                    'dateEnd': self.utc_timestamp(modcon['data_final']),
                     'tariffCostId': tariff_cost_id
                 })
                 contract['tariffHistory'].append({
-                    'dateStart': make_utc_timestamp(modcon['data_inici']),
-                    'dateEnd': make_utc_timestamp(modcon['data_final']),
+                    'dateStart': self.utc_timestamp(modcon['data_inici']),
+                    'dateEnd': self.utc_timestamp(modcon['data_final']),
                     'tariffId': mod_tarifa_atr
                 })
 
                 # Fill tertiaryPowerHistory and powerHistory fields
                 tertiary_power_history = {
-                    'dateStart': make_utc_timestamp(modcon['data_inici']),
-                    'dateEnd': make_utc_timestamp(modcon['data_final']),
+                    'dateStart': self.utc_timestamp(modcon['data_inici']),
+                    'dateEnd': self.utc_timestamp(modcon['data_final']),
                 }
                 for period, power in modcon_obj.get_potencies_dict(modcon['id']).items():
                     tertiary_power_history[period.lower()] = int(power * 1000)
                 contract['tertiaryPowerHistory'].append(tertiary_power_history)
 
                 power_history = {
-                    'dateStart': make_utc_timestamp(modcon['data_inici']),
-                    'dateEnd': make_utc_timestamp(modcon['data_final']),
+                    'dateStart': self.utc_timestamp(modcon['data_inici']),
+                    'dateEnd': self.utc_timestamp(modcon['data_final']),
                     'power': int(modcon['potencia'] * 1000)
                 }
                 contract['powerHistory'].append(power_history)
@@ -534,10 +859,10 @@ class AmonConverter(object):
 
             # Get tertiary power
             contract['tertiaryPower'] = {}
-            for period, power in pol.get_potencies_dict(polissa['id']).items():
+            for period, power in potencies[polissa['id']].items():
                 contract['tertiaryPower'][period.lower()] = int(power * 1000)
             contract['tertiaryPower_'] = contract['tertiaryPower'].copy()
-            contract['tertiaryPower_'].update({'dateStart': make_utc_timestamp(polissa['data_alta'])})
+            contract['tertiaryPower_'].update({'dateStart': self.utc_timestamp(polissa['data_alta'])})
             contract['tertiaryPower_'].update({'dateEnd': None})
 
             # Add custom fields
@@ -545,53 +870,99 @@ class AmonConverter(object):
             if customFields:
                 contract['customFields'] = customFields
 
-            cups = self.cups_to_amon(polissa['cups'][0])
-            recursive_update(contract, cups)
+            recursive_update(contract, cups_amon[polissa['cups'][0]])
             res.append(contract)
         return res
 
+    def read_potencies(self, polisses):
+        """Return a dict contract id -> {period: power} of `polisses`.
+
+        The powers are built from the ``potencies_periode`` records of all
+        the contracts read at once. The contracts without them fall back to
+        ``get_potencies_dict``.
+        """
+        O = self.O
+        periodes = read_by_id(O.GiscedataPolissaPotenciaContractadaPeriode, [
+            p_id for p in polisses for p_id in p['potencies_periode']
+        ], ['periode_id', 'potencia'])
+        names = read_by_id(O.GiscedataPolissaTarifaPeriodes, [
+            p['periode_id'][0] for p in periodes.values() if p['periode_id']
+        ], ['name'])
+        res = {}
+        for polissa in polisses:
+            powers = {}
+            for p_id in polissa['potencies_periode']:
+                periode = periodes.get(p_id)
+                if periode and periode['periode_id']:
+                    name = names[periode['periode_id'][0]]['name']
+                    powers[name] = periode['potencia']
+            if not powers:
+                powers = O.GiscedataPolissa.get_potencies_dict(polissa['id'])
+            res[polissa['id']] = powers
+        return res
+
     def device_to_amon(self, device_ids, force_serial=None):
         if not device_ids:
             return []
         compt_obj = self.O.GiscedataLecturesComptador
-        devices = []
         comptador_fields = ['data_alta', 'data_baixa']
-        for comptador in compt_obj.read(device_ids, comptador_fields):
+        return self.comptadors_to_amon(
+            compt_obj.read(device_ids, comptador_fields), force_serial
+        )
+
+    def comptadors_to_amon(self, comptadors, force_serial=None):
+        """Converts already read meters (data_alta, data_baixa) to AMON.
+        """
+        devices = []
+        for comptador in comptadors:
             devices.append({
-                'dateStart': make_utc_timestamp(comptador['data_alta']),
-                'dateEnd': make_utc_timestamp(comptador['data_baixa']),
-                'deviceId': force_serial or make_uuid('giscedata.lectures.comptador', comptador['id'])
+                'dateStart': self.utc_timestamp(comptador['data_alta']),
+                'dateEnd': self.utc_timestamp(comptador['data_baixa']),
+                'deviceId': force_serial or model_uuid('giscedata.lectures.comptador', comptador['id'])
             })
         return devices
 
     def cups_to_amon(self, cups_id):
+        return self.cups_list_to_amon([cups_id])[cups_id]
+
+    def cups_list_to_amon(self, cups_ids):
+        """Converts many CUPS to AMON with one read per model.
+
+        Returns a dict keyed by CUPS id.
+        """
         cups_obj = self.O.GiscedataCupsPs
         muni_obj = self.O.ResMunicipi
         cups_fields = ['id_municipi', 'tv', 'nv', 'cpa', 'cpo', 'pnp', 'pt',
                        'name', 'es', 'pu', 'dp']
-        if 'empowering' in cups_obj.fields_get():
+        if 'empowering' in self.get_fields('GiscedataCupsPs'):
             cups_fields.append('empowering')
-        cups = cups_obj.read(cups_id, cups_fields)
-        cups_name = cups['name']
-        # Check if CUPS must be informed with 20 characters
-        if int(os.getenv('CUPS_20_CHARACTERS', '0')):
-            cups_name = cups_name[:20]
-        ine = muni_obj.read(cups['id_municipi'][0], ['ine'])['ine']
-        res = {
-            'meteringPointId': make_uuid('giscedata.cups.ps', cups_name),
-            'customer': {
-                'address': {
-                    'city': cups['id_municipi'][1],
-                    'cityCode': ine,
-                    'countryCode': 'ES',
-                    'street': get_street_name(cups),
-                    'postalCode': cups['dp'] or None
-                }
-            },
-            'experimentalGroupUserTest': False,
-            'experimentalGroupUser': bool(cups.get('empowering', 0))
-        }
-        return res
+        cups_list = read_by_id(cups_obj, cups_ids, cups_fields)
+        municipis = REFERENCE_CACHE.get_many('res.municipi', [
+            cups['id_municipi'][0] for cups in cups_list.values()
+        ], lambda ids: read_by_id(muni_obj, ids, ['ine']))
+        result = {}
+        cups_20 = self.config['cups_20_characters']
+        for cups_id, cups in cups_list.items():
+            cups_name = cups['name']
+            # Check if CUPS must be informed with 20 characters
+            if cups_20:
+                cups_name = cups_name[:20]
+            ine = municipis[cups['id_municipi'][0]]['ine']
+            result[cups_id] = {
+                'meteringPointId': model_uuid('giscedata.cups.ps', cups_name),
+                'customer': {
+                    'address': {
+                        'city': cups['id_municipi'][1],
+                        'cityCode': ine,
+                        'countryCode': 'ES',
+                        'street': get_street_name(cups),
+                        'postalCode': cups['dp'] or None
+                    }
+                },
+                'experimentalGroupUserTest': False,
+                'experimentalGroupUser': bool(cups.get('empowering', 0))
+            }
+        return result
 
     def indexed_to_amon(self, indexed_group, fact_ids):
         """
@@ -626,7 +997,9 @@ class AmonConverter(object):
         if df_grouped.empty:
             return res
         df_grouped = df_grouped.groupby('timestamp').median().reset_index()
-        df_grouped['timestamp'] = df_grouped['timestamp'].apply(lambda x: map_datetime(x))
+        df_grouped['timestamp'] = df_grouped['timestamp'].apply(
+            lambda x: map_datetime(x, self.config['timezone'])
+        )
         for ts_indexed_median in df_grouped.T.to_dict().values():
             res.append({
                 'tariffId': str(tariff),
@@ -0,0 +1,65 @@
+# -*- coding: utf-8 -*-
+"""Size of the buckets of items sent to each job.
+
+The jobs instrumented with `instrument_job` keep in Redis their number of
+items, duration and bytes uploaded. `bucket_size` uses them to size the
+next buckets for a target job duration or payload.
+"""
+from __future__ import absolute_import
+import logging
+
+from .metrics import job_timings
+from .utils import config_from_environment
+
+
+logger = logging.getLogger('amon')
+
+
+def setup_batching(**kwargs):
+    """Bucket sizing settings, can be overridden with BATCHING_* vars.
+
+    * target_seconds: duration of the jobs to aim at, 0 to disable.
+    * target_bytes: bytes uploaded by the jobs to aim at, 0 to disable.
+    * min_bucket / max_bucket: limits of the sizes.
+    * timeout: timeout of the jobs, buckets never take more than half.
+    """
+    config = {
+        'target_seconds': 0,
+        'target_bytes': 0,
+        'min_bucket': 1,
+        'max_bucket': 10000,
+        'timeout': 3600
+    }
+    config.update(kwargs)
+    return config_from_environment('BATCHING', **config)
+
+
+def bucket_size(job_name, bucket, target_seconds=None, config=None):
+    """Return the number of items to send to each `job_name` job.
+
+    Without samples of previous jobs or targets `bucket` is returned. With
+    samples the size never goes over half the job timeout.
+    """
+    config = config or setup_batching()
+    if target_seconds is None:
+        target_seconds = config['target_seconds']
+    samples = job_timings(job_name)
+    items = sum(sample[0] for sample in samples)
+    seconds = sum(sample[1] for sample in samples)
+    bytes_out = sum(sample[2] for sample in samples)
+    if not items:
+        return bucket
+    sizes = []
+    if target_seconds and seconds:
+        sizes.append(target_seconds * items / seconds)
+    if config['target_bytes'] and bytes_out:
+        sizes.append(config['target_bytes'] * items / bytes_out)
+    sizes = sizes or [bucket]
+    if seconds:
+        sizes.append(config['timeout'] / 2.0 * items / seconds)
+    size = int(max(config['min_bucket'], min(config['max_bucket'], *sizes)))
+    logger.info(
+        'Bucket for %s: %s items (%.4f s/item over the last %s jobs)',
+        job_name, size, seconds / items, len(samples)
+    )
+    return size
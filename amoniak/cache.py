@@ -1,20 +1,179 @@
+import json
 import logging
+import time
 
-from .utils import setup_redis
-from modeldict import RedisDict
+from .utils import setup_redis, config_from_environment, LRUCache
 
 
 logger = logging.getLogger('amon')
 
 
-CUPS_CACHE = RedisDict('CUPS_CACHE', setup_redis())
-CUPS_UUIDS = RedisDict('CUPS_UUIDS', setup_redis())
+class RedisIndex(object):
+    """Index stored in one Redis hash with an in-process layer in front.
+
+    Lookups of many keys are done with one ``HMGET`` and the whole index is
+    dropped with one ``DEL``. Values are stored as JSON.
+    """
+    def __init__(self, name, maxsize=100000, ttl=300):
+        self.name = name
+        self.local = LRUCache(maxsize, ttl)
+
+    def get_many(self, keys):
+        """Return a dict with the values found for `keys`.
+        """
+        result = {}
+        missing = []
+        for key in set(keys):
+            value = self.local.get(key)
+            if value is None:
+                missing.append(key)
+            else:
+                result[key] = value
+        if missing:
+            values = setup_redis().hmget(self.name, missing)
+            for key, value in zip(missing, values):
+                if value is not None:
+                    result[key] = json.loads(value)
+                    self.local.set(key, result[key])
+        return result
+
+    def set_many(self, items, chunk=5000):
+        items = list(items.items())
+        conn = setup_redis()
+        for idx in range(0, len(items), chunk):
+            conn.hmset(self.name, dict(
+                (key, json.dumps(value)) for key, value in items[idx:idx + chunk]
+            ))
+        for key, value in items:
+            self.local.set(key, value)
+
+    def __getitem__(self, key):
+        return self.get_many([key])[key]
+
+    def __setitem__(self, key, value):
+        self.set_many({key: value})
+
+    def __contains__(self, key):
+        return key in self.get_many([key])
+
+    def __len__(self):
+        return setup_redis().hlen(self.name)
+
+    def clear(self):
+        setup_redis().delete(self.name)
+        self.local.clear()
+
+
+# Meter serial -> CUPS uuid
+CUPS_CACHE = RedisIndex('amoniak:cups:serials')
+# CUPS uuid -> CUPS id
+CUPS_UUIDS = RedisIndex('amoniak:cups:uuids')
+
+
+class ReferenceCache(object):
+    """Cache for slow changing reference data (municipalities, tariffs...).
+
+    Values are kept in the process for `ttl` seconds and, if `redis` is set,
+    shared with the other processes through Redis. `invalidate` bumps a
+    generation counter in Redis which makes every process drop its values.
+    """
+    GENERATION_KEY = 'amoniak:reference:generation'
+    # Seconds between checks of the generation counter
+    CHECK_INTERVAL = 30
+    _missing = object()
+
+    def __init__(self, ttl=3600, maxsize=10000, redis=False):
+        self.ttl = ttl
+        self.redis = redis
+        self.local = LRUCache(maxsize, ttl)
+        self._generation = None
+        self._checked = 0
+
+    def generation(self):
+        now = time.time()
+        if now - self._checked > self.CHECK_INTERVAL:
+            generation = int(setup_redis().get(self.GENERATION_KEY) or 0)
+            if generation != self._generation:
+                self.local.clear()
+                self._generation = generation
+            self._checked = now
+        return self._generation
+
+    def redis_key(self, name, key):
+        return 'amoniak:reference:{}:{}:{}'.format(
+            self._generation, name, key
+        )
+
+    def get_many(self, name, keys, loader):
+        """Return a dict with the values of `keys` of `name`.
+
+        The keys not cached are loaded with one call to ``loader(keys)``,
+        which must return a dict.
+        """
+        self.generation()
+        result = {}
+        missing = []
+        for key in set(keys):
+            value = self.local.get((name, key), self._missing)
+            if value is self._missing:
+                missing.append(key)
+            else:
+                result[key] = value
+        if missing and self.redis:
+            cached = setup_redis().mget(
+                [self.redis_key(name, key) for key in missing]
+            )
+            for key, value in zip(missing, cached):
+                if value is not None:
+                    result[key] = json.loads(value)
+                    self.local.set((name, key), result[key])
+            missing = [key for key in missing if key not in result]
+        if missing:
+            loaded = loader(missing)
+            pipe = self.redis and setup_redis().pipeline()
+            for key, value in loaded.items():
+                result[key] = value
+                self.local.set((name, key), value)
+                if pipe:
+                    pipe.set(self.redis_key(name, key), json.dumps(value))
+                    pipe.expire(self.redis_key(name, key), self.ttl)
+            if pipe:
+                pipe.execute()
+        return result
+
+    def get(self, name, key, loader):
+        """Return the value of `key` of `name` loading it with ``loader()``.
+        """
+        return self.get_many(
+            name, [key], lambda keys: {key: loader()}
+        )[key]
+
+    def invalidate(self):
+        setup_redis().incr(self.GENERATION_KEY)
+        self.local.clear()
+        self._checked = 0
+
+
+def setup_reference_cache(**kwargs):
+    """Reference cache settings, can be overridden with REFCACHE_* vars.
+
+    Other REFCACHE_* vars are ignored.
+    """
+    config = {'ttl': 3600, 'maxsize': 10000, 'redis': False}
+    config.update(kwargs)
+    env_config = config_from_environment('REFCACHE', **config)
+    unknown = sorted(set(env_config) - set(config))
+    if unknown:
+        logger.warning('Ignoring unknown REFCACHE settings: %s',
+                       ', '.join(unknown))
+    return dict((key, env_config[key]) for key in config)
+
+
+REFERENCE_CACHE = ReferenceCache(**setup_reference_cache())
 
 
 def empty():
     logger.debug('Emptying cache...')
-    for k in CUPS_CACHE:
-        del CUPS_CACHE[k]
-    for k in CUPS_UUIDS:
-        del CUPS_UUIDS[k]
+    CUPS_CACHE.clear()
+    CUPS_UUIDS.clear()
     logger.debug('Cache emptied!')
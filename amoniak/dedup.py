@@ -0,0 +1,185 @@
+# -*- coding: utf-8 -*-
+"""Deduplication of the jobs enqueued.
+
+Before enqueuing, the enqueuers claim a key per job type and entity
+(contract, meter...) with ``SET NX`` and a TTL. While the key exists the
+entity is not enqueued again, even if the enqueuer is run before the
+previous jobs are done.
+
+Every claim has its own token, stored in the key, and counts its holders in
+a second key: the enqueuer while it enqueues the jobs of the entity and
+every job not finished yet. The jobs decorated with `release_dedup` get the
+claims with their tokens, refresh the TTL when they start and release them
+when they end. The keys are dropped with the last holder. A job whose claim
+expired meanwhile doesn't touch the claim of the key made after it.
+"""
+from __future__ import absolute_import
+import logging
+from functools import wraps
+from uuid import uuid4
+
+from .utils import config_from_environment, setup_redis
+
+
+logger = logging.getLogger('amon')
+
+# Key -> token of the claims held by this process
+_TOKENS = {}
+
+
+def setup_dedup(**kwargs):
+    """Deduplication settings, can be overridden with DEDUP_* vars.
+
+    * ttl: seconds a key is kept if its jobs never start or end, 0 to
+      disable the deduplication. The jobs refresh it when they start, so it
+      must be longer than the time the jobs wait in the queue.
+    """
+    config = {'ttl': 6 * 3600}
+    config.update(kwargs)
+    return config_from_environment('DEDUP', **config)
+
+
+DEDUP_CONFIG = setup_dedup()
+
+
+def dedup_keys(kind, entities):
+    return ['amoniak:dedup:{}:{}'.format(kind, e) for e in entities]
+
+
+def holders_key(key):
+    return '{}:holders'.format(key)
+
+
+def claim(kind, entities):
+    """Return the `entities` of `kind` without pending jobs and claim them.
+
+    The claim of the caller must be given to the jobs with `delay_claimed`
+    or `hand_over` and dropped with `release`.
+    """
+    entities = list(entities)
+    ttl = DEDUP_CONFIG['ttl']
+    if not ttl or not entities:
+        return entities
+    token = uuid4().hex
+    keys = dedup_keys(kind, entities)
+    conn = setup_redis()
+    pipe = conn.pipeline()
+    for key in keys:
+        pipe.set(key, token, nx=True, ex=ttl)
+    claimed = [(e, key) for e, key, ok in zip(entities, keys, pipe.execute())
+               if ok]
+    pipe = conn.pipeline()
+    for _, key in claimed:
+        pipe.set(holders_key(key), 1, ex=ttl)
+        _TOKENS[key] = token
+    pipe.execute()
+    if len(claimed) < len(entities):
+        logger.info('Skipping %s %s with pending jobs',
+                    len(entities) - len(claimed), kind)
+    return [e for e, _ in claimed]
+
+
+def refresh_claims(claims):
+    """Restart the TTL of the `claims` still held, as (key, token) pairs.
+    """
+    ttl = DEDUP_CONFIG['ttl']
+    if not claims or not ttl:
+        return
+    conn = setup_redis()
+    held = [key for key, token in claims if conn.get(key) == token]
+    pipe = conn.pipeline()
+    for key in held:
+        pipe.expire(key, ttl)
+        pipe.expire(holders_key(key), ttl)
+    pipe.execute()
+
+
+def release_claims(claims):
+    """Drop a holder of every claim, as (key, token) pairs. The claims
+    without holders are deleted.
+
+    Claims that expired, and maybe were claimed again, are ignored.
+    """
+    if not claims or not DEDUP_CONFIG['ttl']:
+        return
+    conn = setup_redis()
+    for key, token in claims:
+
+        def release_claim(pipe):
+            if pipe.get(key) != token:
+                logger.warning('Claim %s expired before its jobs ended', key)
+                pipe.multi()
+                return
+            holders = int(pipe.get(holders_key(key)) or 0) - 1
+            pipe.multi()
+            if holders > 0:
+                pipe.decr(holders_key(key))
+            else:
+                pipe.delete(key, holders_key(key))
+
+        conn.transaction(release_claim, key, holders_key(key))
+
+
+def caller_claims(kind, entities):
+    keys = dedup_keys(kind, entities)
+    return [(key, _TOKENS.get(key)) for key in keys if key in _TOKENS]
+
+
+def release(kind, entities):
+    """Drop the claim of the caller on `entities`.
+    """
+    claims = caller_claims(kind, entities)
+    for key, _ in claims:
+        del _TOKENS[key]
+    release_claims(claims)
+
+
+def hand_over(kind, entities):
+    """Give the claim of the caller on `entities` to a job.
+
+    Returns the claims to pass as ``dedup_claims`` to the job.
+    """
+    claims = caller_claims(kind, entities)
+    for key, _ in claims:
+        del _TOKENS[key]
+    return claims
+
+
+def delay_claimed(func, kind, entity, *args):
+    """Enqueue ``func(*args)`` as one more job of the claimed `entity`.
+    """
+    claims = caller_claims(kind, [entity])
+    if claims:
+        key = claims[0][0]
+        pipe = setup_redis().pipeline()
+        pipe.incr(holders_key(key))
+        pipe.expire(holders_key(key), DEDUP_CONFIG['ttl'])
+        pipe.expire(key, DEDUP_CONFIG['ttl'])
+        pipe.execute()
+    return func.delay(*args, dedup_claims=claims)
+
+
+def delay_once(func, kind, entity, *args):
+    """Enqueue ``func(*args)`` unless there are pending jobs for `entity`.
+
+    The claim is handed to the job. Returns the job or None if it was not
+    enqueued.
+    """
+    if not claim(kind, [entity]):
+        return None
+    return func.delay(*args, dedup_claims=hand_over(kind, [entity]))
+
+
+def release_dedup(func):
+    """Refresh the claims passed in ``dedup_claims`` when the job `func`
+    starts and release them when it ends.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        claims = kwargs.pop('dedup_claims', None)
+        refresh_claims(claims)
+        try:
+            return func(*args, **kwargs)
+        finally:
+            release_claims(claims)
+    return wrapper
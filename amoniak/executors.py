@@ -0,0 +1,131 @@
+# -*- coding: utf-8 -*-
+"""Empowering client reusing its HTTP connections.
+
+urllib2 opens a connection per request, so every upload pays a TCP and TLS
+handshake. `KeepAliveHandler` keeps the connections open per thread and
+host, and `KeepAliveEmpowering` installs it in the executor together with
+the handlers of `empowering` (login, filters).
+"""
+from __future__ import absolute_import
+import errno
+import httplib
+import logging
+import socket
+import threading
+import urllib
+import urllib2
+from StringIO import StringIO
+
+from empowering import Empowering
+from empowering.executors.urllib2_executor import (
+    HTTPEmpoweringFilterHandler, Urllib2Executor
+)
+from libsaas.executors import base
+
+
+logger = logging.getLogger('amon')
+
+# Errors sending a request on a connection the server closed meanwhile
+STALE_ERRNOS = (errno.ECONNRESET, errno.EPIPE)
+
+
+class KeepAliveHandler(urllib2.HTTPHandler, urllib2.HTTPSHandler):
+    """HTTP(S) handler with a persistent connection per thread and host.
+
+    The responses are read at once so the connection can be used by the
+    next request. A request failing on a reused connection because the
+    server closed it meanwhile (reset while sending or closed before
+    answering anything) is retried on a new one. Any other error, timeouts
+    included, is raised as the request may have been processed.
+    """
+
+    def __init__(self, key_file=None, cert_file=None):
+        urllib2.HTTPHandler.__init__(self)
+        self.key_file = key_file
+        self.cert_file = cert_file
+        self.local = threading.local()
+
+    @property
+    def connections(self):
+        if not hasattr(self.local, 'connections'):
+            self.local.connections = {}
+        return self.local.connections
+
+    def get_connection(self, req):
+        key = (req.get_type(), req.get_host())
+        conn = self.connections.get(key)
+        if conn is not None:
+            return conn, True
+        if key[0] == 'https':
+            conn = httplib.HTTPSConnection(
+                key[1], key_file=self.key_file, cert_file=self.cert_file,
+                timeout=req.timeout
+            )
+        else:
+            conn = httplib.HTTPConnection(key[1], timeout=req.timeout)
+        self.connections[key] = conn
+        return conn, False
+
+    def close_connection(self, req):
+        conn = self.connections.pop((req.get_type(), req.get_host()), None)
+        if conn is not None:
+            conn.close()
+
+    def keepalive_open(self, req):
+        if not req.get_host():
+            raise urllib2.URLError('no host given')
+        # Same headers as urllib2 but without "Connection: close"
+        headers = dict(req.unredirected_hdrs)
+        headers.update(dict(
+            (k, v) for k, v in req.headers.items() if k not in headers
+        ))
+        headers = dict((name.title(), val) for name, val in headers.items())
+        while True:
+            conn, reused = self.get_connection(req)
+            stale = False
+            try:
+                try:
+                    conn.request(
+                        req.get_method(), req.get_selector(), req.data,
+                        headers
+                    )
+                except socket.error as error:
+                    stale = error.errno in STALE_ERRNOS
+                    raise
+                try:
+                    r = conn.getresponse()
+                except httplib.BadStatusLine:
+                    # Closed without answering a single byte
+                    stale = True
+                    raise
+                body = r.read()
+            except (httplib.HTTPException, socket.error) as error:
+                self.close_connection(req)
+                if reused and stale:
+                    logger.debug('Connection to %s lost, reconnecting',
+                                 req.get_host())
+                    continue
+                raise urllib2.URLError(error)
+            if r.will_close:
+                self.close_connection(req)
+            resp = urllib.addinfourl(
+                StringIO(body), r.msg, req.get_full_url(), r.status
+            )
+            resp.msg = r.reason
+            return resp
+
+    http_open = https_open = keepalive_open
+
+
+class KeepAliveEmpowering(Empowering):
+    """`Empowering` client sending its requests with `KeepAliveHandler`.
+    """
+
+    def setup_executor(self, extra_handlers=None):
+        if extra_handlers is None:
+            extra_handlers = ()
+        extra_handlers += (
+            HTTPEmpoweringFilterHandler(),
+            KeepAliveHandler(self.key_file, self.cert_file)
+        )
+        base.use_executor(Urllib2Executor(extra_handlers))
@@ -0,0 +1,343 @@
+# -*- coding: utf-8 -*-
+"""Instrumentation of the jobs.
+
+Every job decorated with `instrument_job` collects the calls made to the ERP
+and to the Empowering API (count, time and size) and the time spent in each
+phase of the job (fetch, convert, upload, write-back). At the end they are
+stored in the ``metrics`` key of the RQ job meta and, if configured, sent to
+StatsD or written as Prometheus text.
+"""
+from __future__ import absolute_import
+import json
+import logging
+import os
+import socket
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+from functools import wraps
+from urlparse import urlparse
+
+from .utils import config_from_environment, setup_redis
+
+
+logger = logging.getLogger('amon')
+
+_CURRENT = {'metrics': None}
+
+# Number of (items, seconds, bytes) samples kept per job function
+TIMING_SAMPLES = 50
+
+
+def setup_metrics(**kwargs):
+    """Metrics export settings, can be overridden with METRICS_* vars.
+
+    * statsd: ``host:port`` of a StatsD server.
+    * prometheus: directory where a ``.prom`` file per job function is
+      written, as read by the node exporter textfile collector.
+    """
+    config = {
+        'statsd': None,
+        'prometheus': None,
+        'prefix': 'amoniak'
+    }
+    config.update(kwargs)
+    return config_from_environment('METRICS', **config)
+
+
+class JobMetrics(object):
+    """Counters and timings of one job.
+    """
+
+    def __init__(self, name):
+        self.name = name
+        self.items = 0
+        self.seconds = 0
+        self.lock = threading.Lock()
+        self.phases = defaultdict(float)
+        # (kind, key) -> {'calls', 'seconds', 'bytes_out', 'bytes_in'}
+        self.calls = defaultdict(lambda: defaultdict(float))
+
+    @contextmanager
+    def phase(self, name):
+        start = time.time()
+        try:
+            yield
+        finally:
+            with self.lock:
+                self.phases[name] += time.time() - start
+
+    def record(self, kind, key, seconds, bytes_out=0, bytes_in=0):
+        with self.lock:
+            call = self.calls[(kind, key)]
+            call['calls'] += 1
+            call['seconds'] += seconds
+            call['bytes_out'] += bytes_out
+            call['bytes_in'] += bytes_in
+
+    def totals(self, kind):
+        totals = defaultdict(float)
+        for (call_kind, _), call in self.calls.items():
+            if call_kind == kind:
+                for k, v in call.items():
+                    totals[k] += v
+        return dict(totals)
+
+    def as_dict(self):
+        return {
+            'job': self.name,
+            'items': self.items,
+            'seconds': self.seconds,
+            'phases': dict(self.phases),
+            'erp': self.totals('erp'),
+            'http': self.totals('http'),
+            'calls': dict(
+                ('{}:{}'.format(*key), dict(call))
+                for key, call in self.calls.items()
+            )
+        }
+
+
+def current_metrics():
+    return _CURRENT['metrics']
+
+
+@contextmanager
+def phase(name):
+    """Time a phase of the current job, does nothing outside of a job.
+    """
+    metrics = current_metrics()
+    if metrics is None:
+        yield
+    else:
+        with metrics.phase(name):
+            yield
+
+
+def count_items(items):
+    """Set the number of items (measures, contracts...) of the current job.
+    """
+    metrics = current_metrics()
+    if metrics is not None:
+        metrics.items = items
+
+
+def timings_key(name):
+    return 'amoniak:timings:{}'.format(name)
+
+
+def save_timing(metrics):
+    """Keep the time and bytes sent of the job to size the next ones.
+    """
+    if not metrics.items:
+        return
+    sample = [
+        metrics.items, metrics.seconds,
+        metrics.totals('http').get('bytes_out', 0)
+    ]
+    pipe = setup_redis().pipeline()
+    pipe.lpush(timings_key(metrics.name), json.dumps(sample))
+    pipe.ltrim(timings_key(metrics.name), 0, TIMING_SAMPLES - 1)
+    pipe.execute()
+
+
+def job_timings(name):
+    """Return the last (items, seconds, bytes) samples of the job `name`.
+    """
+    return [
+        json.loads(sample)
+        for sample in setup_redis().lrange(timings_key(name), 0, -1)
+    ]
+
+
+def timed(func, kind, key):
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        start = time.time()
+        try:
+            return func(*args, **kwargs)
+        finally:
+            metrics = current_metrics()
+            if metrics is not None:
+                metrics.record(kind, key, time.time() - start)
+    return wrapper
+
+
+class InstrumentedModel(object):
+    """Proxy of an ERP model (erppeek `Model` or `ModelWrapper`) timing every
+    method call.
+
+    Reads done lazily by browse records are not counted.
+    """
+
+    def __init__(self, model, name):
+        self._model = model
+        self._name = name
+
+    def __getattr__(self, name):
+        attr = getattr(self._model, name)
+        if callable(attr):
+            return timed(attr, 'erp', '{}.{}'.format(self._name, name))
+        return attr
+
+
+class InstrumentedERP(object):
+    """Proxy of an ERP client (erppeek `Client` or `PoolWrapper`) returning
+    instrumented models.
+    """
+
+    def __init__(self, client):
+        self._client = client
+
+    def model(self, name):
+        return InstrumentedModel(self._client.model(name), name)
+
+    def __getattr__(self, name):
+        attr = getattr(self._client, name)
+        if hasattr(attr, 'search'):
+            return InstrumentedModel(attr, name)
+        if callable(attr):
+            return timed(attr, 'erp', name)
+        return attr
+
+
+def instrument_erp(client):
+    """Return `client` counting its calls in the current job.
+    """
+    if current_metrics() is None or isinstance(client, InstrumentedERP):
+        return client
+    return InstrumentedERP(client)
+
+
+def instrumented_executor(executor):
+    """Wrap a libsaas executor to count the requests in the current job.
+    """
+    def execute(request, parser):
+        metrics = current_metrics()
+        if metrics is None:
+            return executor(request, parser)
+        # /<version>/<resource>[/<id>]
+        path = urlparse(request.uri).path.strip('/').split('/')
+        key = '{} {}'.format(request.method, len(path) > 1 and path[1] or path[0])
+        sizes = {'in': 0}
+
+        def parse(body, code, headers):
+            sizes['in'] = len(body or '')
+            return parser(body, code, headers)
+
+        params = request.params
+        bytes_out = isinstance(params, basestring) and len(params) or 0
+        start = time.time()
+        try:
+            return executor(request, parse)
+        finally:
+            metrics.record(
+                'http', key, time.time() - start, bytes_out, sizes['in']
+            )
+    execute.instrumented = True
+    return execute
+
+
+def instrument_api(em):
+    """Count the requests of the Empowering client `em` in the current job.
+
+    The client sets a new libsaas executor when it's created or logs in, so
+    it must be called after getting the client.
+    """
+    from libsaas.executors import base
+    executor = base.current_executor()
+    if not getattr(executor, 'instrumented', False):
+        base.use_executor(instrumented_executor(executor))
+    return em
+
+
+def statsd_lines(metrics, prefix):
+    name = '{}.{}'.format(prefix, metrics.name)
+    lines = []
+    for phase_name, seconds in metrics.phases.items():
+        lines.append('{}.phase.{}:{}|ms'.format(
+            name, phase_name, int(seconds * 1000)
+        ))
+    for kind in ('erp', 'http'):
+        totals = metrics.totals(kind)
+        lines.append('{}.{}.calls:{}|c'.format(
+            name, kind, int(totals.get('calls', 0))
+        ))
+        lines.append('{}.{}.time:{}|ms'.format(
+            name, kind, int(totals.get('seconds', 0) * 1000)
+        ))
+    return lines
+
+
+def prometheus_text(metrics, prefix):
+    labels = 'job="{}"'.format(metrics.name)
+    lines = [
+        '# TYPE {}_job_phase_seconds gauge'.format(prefix),
+    ]
+    for phase_name, seconds in sorted(metrics.phases.items()):
+        lines.append('{}_job_phase_seconds{{{},phase="{}"}} {}'.format(
+            prefix, labels, phase_name, seconds
+        ))
+    for metric in ('calls', 'seconds', 'bytes_out', 'bytes_in'):
+        lines.append('# TYPE {}_job_{} gauge'.format(prefix, metric))
+        for (kind, key), call in sorted(metrics.calls.items()):
+            lines.append('{}_job_{}{{{},kind="{}",call="{}"}} {}'.format(
+                prefix, metric, labels, kind, key, call[metric]
+            ))
+    return '\n'.join(lines) + '\n'
+
+
+def export(metrics, config=None):
+    config = config or setup_metrics()
+    prefix = config['prefix']
+    if config['statsd']:
+        host, port = config['statsd'].split(':')
+        sock = socket.socket(socket.AF_INET, socket.SOCK_DGRAM)
+        try:
+            for line in statsd_lines(metrics, prefix):
+                sock.sendto(line, (host, int(port)))
+        finally:
+            sock.close()
+    if config['prometheus']:
+        path = os.path.join(
+            config['prometheus'], '{}_{}.prom'.format(prefix, metrics.name)
+        )
+        # Write and rename so the collector never reads half a file
+        with open(path + '.tmp', 'w') as prom:
+            prom.write(prometheus_text(metrics, prefix))
+        os.rename(path + '.tmp', path)
+
+
+def instrument_job(func):
+    """Collect the metrics of the job `func`.
+    """
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        from rq import Connection, get_current_job
+        metrics = JobMetrics(func.__name__)
+        _CURRENT['metrics'] = metrics
+        start = time.time()
+        try:
+            result = func(*args, **kwargs)
+        except Exception:
+            # Failed jobs don't tell how long the next ones will take
+            metrics.items = 0
+            raise
+        finally:
+            _CURRENT['metrics'] = None
+            metrics.seconds = time.time() - start
+            data = metrics.as_dict()
+            logger.info('Job %s metrics: %s', func.__name__, data)
+            with Connection(setup_redis()):
+                job = get_current_job()
+            if job is not None:
+                job.meta['metrics'] = data
+                job.save()
+            try:
+                save_timing(metrics)
+                export(metrics)
+            except Exception:
+                logger.exception('Error exporting the metrics')
+        return result
+    return wrapper
@@ -0,0 +1,69 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import json
+
+from empowering.service import Contracts
+from libsaas import http, parsers
+from libsaas.services import base
+
+
+class ContractsState(Contracts):
+    """Contracts collection returning only their sync state.
+    """
+
+    @base.apimethod
+    def get_state(self, where=None, page=None, max_results=None):
+        params = base.get_params(('where', 'page', 'max_results'), locals())
+        params['projection'] = json.dumps({'contractId': 1})
+        request = http.Request('GET', self.get_url(), params)
+        return request, parsers.parse_json
+
+
+def get_contracts_state(em, contracts=None, max_results=500, chunk=100):
+    """Return ``_updated`` and ``_etag`` of the contracts in Empowering.
+
+    Pages through the contracts collection and returns a dict keyed by
+    ``contractId``. If `contracts` is passed only these are fetched, in
+    chunks of `chunk` names to keep the URLs short.
+    """
+    if not contracts:
+        return fetch_contracts_state(em, None, max_results)
+    contracts = sorted(set(contracts))
+    state = {}
+    for idx in range(0, len(contracts), chunk):
+        where = json.dumps({
+            'contractId': {'$in': contracts[idx:idx + chunk]}
+        })
+        state.update(fetch_contracts_state(em, where, max_results))
+    return state
+
+
+def fetch_contracts_state(em, where, max_results):
+    """Page through the contracts matching `where`.
+
+    Raises if the number of contracts got is not the ``_meta.total`` of the
+    API, the missing ones would be taken as deleted.
+    """
+    state = {}
+    page = 1
+    n_items = 0
+    while True:
+        result = ContractsState(em).get_state(
+            where=where, page=page, max_results=max_results
+        )
+        total = result.get('_meta', {}).get('total')
+        for item in result.get('_items', []):
+            n_items += 1
+            state[item['contractId']] = {
+                '_updated': item['_updated'],
+                '_etag': item['_etag']
+            }
+        if 'next' not in result.get('_links', {}):
+            break
+        page += 1
+    if total is not None and n_items != total:
+        raise Exception(
+            'Got {} contracts of {} from Empowering, stopped at page '
+            '{}'.format(n_items, total, page)
+        )
+    return state
@@ -6,7 +6,7 @@ import os
 import click
 
 from amoniak import tasks
-from amoniak.utils import setup_logging
+from amoniak.utils import setup_logging, setup_queue, setup_redis
 from amoniak import VERSION
 
 
@@ -35,8 +35,14 @@ def amoniak(log_level, async):
 
 @amoniak.command()
 @click.option('--force', default=False, is_flag=True)
+@click.option('--incremental', default=False, is_flag=True,
+              help='Only check what changed since the last run')
+@click.option('--bucket', default=500, type=int,
+              help='Items per job, the first size if --target-seconds is set')
+@click.option('--target-seconds', default=None, type=float,
+              help='Size the jobs to last about N seconds')
 @click.argument('contracts', nargs=-1)
-def enqueue_measures(contracts, force):
+def enqueue_measures(contracts, force, incremental, bucket, target_seconds):
     logger = logging.getLogger('amon')
     force_log = force and '(F) ' or ''
     if contracts:
@@ -45,13 +51,27 @@ def enqueue_measures(contracts, force):
         logger.info('{}Enqueuing all measures with etag'.format(force_log))
         contracts = None
     logger.info('Enqueuing measures')
-    tasks.enqueue_measures(contracts=contracts, force=force)
+    tasks.enqueue_measures(
+        bucket=bucket, contracts=contracts, force=force,
+        incremental=incremental, target_seconds=target_seconds
+    )
 
 
 @amoniak.command()
 @click.option('--force', default=False, is_flag=True)
+@click.option('--bulk', default=0, type=int,
+              help='Search profiles for groups of N contracts at once')
+@click.option('--payload', default=False, is_flag=True,
+              help='Send the profiles within the jobs')
+@click.option('--incremental', default=False, is_flag=True,
+              help='Only check what changed since the last run')
+@click.option('--bucket', default=500, type=int,
+              help='Items per job, the first size if --target-seconds is set')
+@click.option('--target-seconds', default=None, type=float,
+              help='Size the jobs to last about N seconds')
 @click.argument('contracts', nargs=-1)
-def enqueue_profiles(contracts, force):
+def enqueue_profiles(contracts, force, bulk, payload, incremental, bucket,
+                     target_seconds):
     logger = logging.getLogger('amon')
     force_log = force and '(F) ' or ''
     if contracts:
@@ -60,7 +80,11 @@ def enqueue_profiles(contracts, force):
         logger.info('{}Enqueuing all profiles with etag'.format(force_log))
         contracts = None
     logger.info('Enqueuing measures')
-    tasks.enqueue_profiles(contracts=contracts, force=force)
+    tasks.enqueue_profiles(
+        bucket=bucket, contracts=contracts, force=force, bulk=bulk,
+        payload=payload, incremental=incremental,
+        target_seconds=target_seconds
+    )
 
 
 @amoniak.command()
@@ -78,16 +102,26 @@ def enqueue_tariffs(tariffs):
 
 @amoniak.command()
 @click.option('--force', default=False, is_flag=True)
-def enqueue_new_contracts(force):
+@click.option('--bucket', default=1, type=int,
+              help='Items per job, the first size if --target-seconds is set')
+@click.option('--target-seconds', default=None, type=float,
+              help='Size the jobs to last about N seconds')
+def enqueue_new_contracts(force, bucket, target_seconds):
     logger = logging.getLogger('amon')
     logger.info('Enqueuing new contracts')
-    tasks.enqueue_new_contracts(force=force)
+    tasks.enqueue_new_contracts(
+        bucket=bucket, force=force, target_seconds=target_seconds
+    )
 
 
 @amoniak.command()
 @click.option('--force', default=False, is_flag=True)
+@click.option('--workers', default=1, type=int,
+              help='Number of processes checking the contracts')
+@click.option('--incremental', default=False, is_flag=True,
+              help='Only check what changed since the last run')
 @click.argument('contracts', nargs=-1)
-def enqueue_contract(contracts, force):
+def enqueue_contract(contracts, force, workers, incremental):
     logger = logging.getLogger('amon')
     force_log = force and '(F) ' or ''
     if contracts:
@@ -95,7 +129,7 @@ def enqueue_contract(contracts, force):
     else:
         logger.info('{}Enqueuing all contracts without etag'.format(force_log))
         contracts = None
-    tasks.enqueue_contracts(contracts, force)
+    tasks.enqueue_contracts(contracts, force, workers, incremental)
 
 @amoniak.command()
 @click.option('--force', default=False, is_flag=True)
@@ -106,5 +140,69 @@ def enqueue_indexed(force, pricelist, wreport):
     logger.info('Enqueuing indexed data')
     tasks.enqueue_indexed(force=force, pricelist=pricelist, wreport=wreport)
 
+
+@amoniak.command()
+def invalidate_cache():
+    """Drop the cached reference data (municipalities, tariffs...).
+    """
+    from amoniak.cache import REFERENCE_CACHE
+    logger = logging.getLogger('amon')
+    logger.info('Invalidating reference data cache')
+    REFERENCE_CACHE.invalidate()
+
+
+@amoniak.command()
+@click.option('--clear', default=False, is_flag=True,
+              help='Empty the index instead of filling it')
+def index_cups(clear):
+    """Fill the meter serial -> CUPS index with all the meters.
+    """
+    from amoniak import cache
+    from amoniak.amon import AmonConverter
+    from amoniak.utils import get_peek
+    logger = logging.getLogger('amon')
+    if clear:
+        cache.empty()
+        return
+    serials = AmonConverter(get_peek()).index_cups_devices()
+    logger.info('Indexed %s meters', len(serials))
+
+
+@amoniak.command()
+@click.option('--interval', default=0, type=int,
+              help='Keep flushing every N seconds')
+def flush_watermarks(interval):
+    """Write the watermarks journal back to the ERP.
+    """
+    import time
+    logger = logging.getLogger('amon')
+    while True:
+        logger.info('Flushing watermarks')
+        if not interval:
+            tasks.flush_watermarks()
+            break
+        try:
+            tasks.flush_watermarks()
+        except Exception:
+            # Keep flushing, the failed watermarks are retried next time
+            logger.exception('Error flushing watermarks')
+        time.sleep(interval)
+
+
+@amoniak.command()
+@click.option('--burst', default=False, is_flag=True)
+@click.argument('queues', nargs=-1)
+def worker(queues, burst):
+    """Run a worker which keeps its caches between jobs.
+    """
+    from amoniak.worker import SimpleWorker
+    logger = logging.getLogger('amon')
+    queues = queues or ['default']
+    logger.info('Starting worker for queues: {}'.format(', '.join(queues)))
+    w = SimpleWorker(
+        [setup_queue(name=q) for q in queues], connection=setup_redis()
+    )
+    w.work(burst=burst)
+
 if __name__ == '__main__':
     amoniak(obj={})
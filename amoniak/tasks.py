@@ -5,13 +5,26 @@ from dateutil.relativedelta import relativedelta
 import logging
 import urllib2
 
-import libsaas
-
 from .utils import (
-    setup_peek, setup_empowering_api, setup_redis,
-    sorted_by_key, Popper, setup_queue
+    setup_peek, get_peek, get_empowering_api, reset_clients, setup_redis,
+    sorted_by_key, setup_queue, chunks, search_pages
+)
+from .upload import create_documents, concurrent_map
+from .resources import get_contracts_state
+from .metrics import (
+    instrument_job, instrument_erp, instrument_api, phase, count_items
+)
+from .batching import bucket_size
+from .dedup import (
+    claim, release, hand_over, delay_claimed, delay_once, release_dedup
+)
+from .watermarks import (
+    WATERMARKS_CONFIG, MEASURES_WATERMARKS, PROFILES_WATERMARKS, ScanCursor
+)
+from .amon import (
+    AmonConverter, check_response, PROFILE_FIELDS, encode_profiles,
+    decode_profiles
 )
-from .amon import AmonConverter, check_response
 from rq.decorators import job
 from raven import Client
 from empowering.utils import make_local_timestamp
@@ -20,6 +33,11 @@ from empowering.utils import make_local_timestamp
 sentry = Client()
 logger = logging.getLogger('amon')
 
+PROFILES_ORDER = 'datetime asc, id asc'
+
+# Contracts state of the processes checking contracts in shards
+_SHARD_STATES = {}
+
 
 def enqueue_tariffs(tariffs=None):
     c = setup_peek()
@@ -42,76 +60,440 @@ def enqueue_tariffs(tariffs=None):
                 push_tariffs.delay(t)
 
 
-def enqueue_profiles(bucket=500, contracts=None, force=False):
+def search_changed(model, since, search_params=None):
+    """Return the ids of `model` created or written after `since`.
+    """
+    return model.search((search_params or []) + [
+        '|',
+        ('create_date', '>', since),
+        ('write_date', '>', since)
+    ], context={'active_test': False})
+
+
+def read_related_ids(model, ids, field, chunk=5000):
+    """Return the ids of the many2one `field` of the records `ids`.
+    """
+    related = set()
+    for ids_chunk in chunks(list(ids), chunk):
+        for record in model.read(ids_chunk, [field]):
+            if record[field]:
+                related.add(record[field][0])
+    return sorted(related)
+
+
+def get_changed_curve_cups(c, since, page=5000, chunk=500):
+    """Return the ids of the CUPS with profiles changed after `since`.
+
+    The names of the curves are resolved to CUPS by their 20 characters
+    prefix, searching `chunk` CUPS at a time.
+    """
+    names = set()
+    for collection in ['tg.cchfact', 'tg.f1']:
+        model = c.model(collection)
+        search_params = [
+            '|', ('create_date', '>', since), ('write_date', '>', since)
+        ]
+        for profiles_ids in search_pages(model, search_params, page):
+            names.update(p['name'] for p in model.read(profiles_ids, ['name']))
+    prefixes = sorted(set(name[:20] for name in names if name))
+    cups_ids = set()
+    for prefixes_chunk in chunks(prefixes, chunk):
+        cups_ids.update(c.GiscedataCupsPs.search(
+            cups_prefix_domain('name', prefixes_chunk),
+            context={'active_test': False}
+        ))
+    return sorted(cups_ids)
+
+
+def cups_prefix_domain(field, cups_names):
+    """Return a domain matching `field` starting with the 20 characters of
+    any of `cups_names`.
+
+    The suffix of the CUPS (``0F``, ``1P``...) is not known from the curves
+    nor from the jobs, so they are matched by the 20 characters prefix.
+    """
+    prefixes = sorted(set(cups[:20] for cups in cups_names))
+    return ['|'] * (len(prefixes) - 1) + [
+        (field, '=like', '{}%'.format(prefix)) for prefix in prefixes
+    ]
+
+
+def get_profiles_dates(polissa, force=False):
+    """Return the (from_date, to_date) window of profiles to push.
+    """
+    last_measure = polissa.get('empowering_last_profile_measure')
+    if not last_measure or force:
+        logger.info("Les pugem totes")
+        from_date = (
+            datetime.now() - relativedelta(years=3)
+        ).strftime('%Y-%m-%d')
+        from_date = max(polissa['data_alta'], from_date)
+        from_date = '{} 01:00:00'.format(from_date)
+    else:
+        from_date = last_measure
+    if polissa['data_baixa']:
+        to_date = (
+            datetime.strptime(polissa['data_baixa'], '%Y-%m-%d') + relativedelta(days=1)
+        ).strftime('%Y-%m-%d 00:00:00')
+    else:
+        to_date = ''
+    return from_date, to_date
+
+
+def update_last_profile_measures(c, last_measures):
+    """Advance the ``empowering_last_profile_measure`` of the contracts.
+
+    Raises if a CUPS has more than one contract, after writing the others.
+    """
+    errors = write_last_profile_measures(c, last_measures)
+    if errors:
+        raise Exception('\n'.join(
+            errors[cups] for cups in sorted(errors)
+        ))
+
+
+def write_last_profile_measures(c, last_measures):
+    """Advance the ``empowering_last_profile_measure`` of the contracts.
+
+    `last_measures` is a dict of CUPS name to the last pushed measure. The
+    contracts of all the CUPS are found by the 20 characters of the CUPS
+    with one search and one read, and written with one call per distinct
+    measure.
+
+    Returns a dict with the CUPS that have more than one contract.
+    """
+    if not last_measures:
+        return {}
+    by_cups = {}
+    for cups, last_measure in last_measures.items():
+        by_cups[cups[:20]] = max(last_measure, by_cups.get(cups[:20]))
+    pol_obj = c.GiscedataPolissa
+    pol_ids = pol_obj.search(cups_prefix_domain('cups.name', by_cups) + [
+        ('state', 'not in', ('esborrany', 'validar', 'cancelada', 'baixa')),
+        ('data_alta', '<=', max(by_cups.values())),
+        '|',
+        ('data_baixa', '>=', min(by_cups.values())),
+        ('data_baixa', '=', False)
+    ], context={'active_test': False})
+    fields_to_read = [
+        'name', 'cups', 'data_alta', 'data_baixa',
+        'empowering_last_profile_measure'
+    ]
+    contracts = {}
+    for pol in pol_obj.read(pol_ids, fields_to_read) if pol_ids else []:
+        cups = pol['cups'][1][:20]
+        # The dates of the contract are compared as days, like the ERP does
+        day = by_cups[cups][:10]
+        if pol['data_alta'] > day or (pol['data_baixa'] and pol['data_baixa'] < day):
+            continue
+        contracts.setdefault(cups, []).append(pol)
+    to_write = {}
+    errors = {}
+    for cups, pols in sorted(contracts.items()):
+        last_measure = by_cups[cups]
+        if len(pols) > 1:
+            errors[cups] = '{} contracts found! CUPS: {}. Last measure: {}'.format(
+                len(pols), cups, last_measure
+            )
+            continue
+        pol = pols[0]
+        if last_measure > pol['empowering_last_profile_measure']:
+            logger.info('Updating polissa (id: %s) to last measure: %s', pol['name'], last_measure)
+            to_write.setdefault(last_measure, []).append(pol['id'])
+    for last_measure, ids in sorted(to_write.items()):
+        pol_obj.write(ids, {'empowering_last_profile_measure': last_measure})
+    return errors
+
+
+def profiles_entity(collection, contract_name):
+    return '{}:{}'.format(collection, contract_name)
+
+
+def claim_profiles(collection, contract_names):
+    """Return the contracts without pending profiles jobs of `collection`
+    and claim them until `release_profiles`.
+
+    Whatever the buckets are, the profiles of a contract are not enqueued
+    again until all its jobs are done.
+    """
+    entities = dict(
+        (profiles_entity(collection, name), name) for name in contract_names
+    )
+    return [entities[e] for e in claim('profiles', sorted(entities))]
+
+
+def release_profiles(collection, contract_names):
+    release('profiles', [
+        profiles_entity(collection, name) for name in contract_names
+    ])
+
+
+def enqueue_profiles_ids(buckets, collection, contract_name, payload=False):
+    """Enqueue one push job for every bucket of profiles.
+
+    Buckets are lists of profile ids or, if `payload` is set, lists of
+    profiles read with `PROFILE_FIELDS` that are sent encoded in the job.
+    The contract must be claimed with `claim_profiles`.
+
+    Returns the number of profiles enqueued.
+    """
+    n_profiles = 0
+    for pops in buckets:
+        if payload:
+            profiles = encode_profiles(pops)
+        else:
+            profiles = pops
+        j = delay_claimed(
+            push_amon_profiles, 'profiles',
+            profiles_entity(collection, contract_name), profiles, collection
+        )
+        n_profiles += len(pops)
+        logger.info("Job id:%s | %s/%s/%s" % (
+            j.id, contract_name, len(pops), n_profiles)
+        )
+    return n_profiles
+
+
+def read_profiles_pages(model, pages):
+    for profiles_ids in pages:
+        yield sorted(
+            model.read(profiles_ids, PROFILE_FIELDS),
+            key=lambda p: (p['datetime'], p['id'])
+        )
+
+
+def enqueue_profiles(bucket=500, contracts=None, force=False, bulk=0,
+                     payload=False, incremental=False, target_seconds=None):
+    """Enqueue the profiles of the contracts with etag.
+
+    If `bulk` is set the profiles are discovered for groups of `bulk`
+    contracts with one search per collection instead of one per contract.
+    If `payload` is set the profiles are read here and sent within the jobs,
+    so the workers don't have to read them again.
+    If `incremental` is set only the contracts with profiles changed since
+    the last scan are checked.
+    The `bucket` is adapted to the previous jobs, see `bucket_size`.
+    """
     # First get all the contracts that are in sync
     c = setup_peek()
+    bucket = bucket_size('push_amon_profiles', bucket, target_seconds)
+    cursor = ScanCursor('profiles')
+    scan_start = cursor.now()
+    since = incremental and not contracts and cursor.get()
     # TODO: Que fem amb les de baixa? les agafem igualment? només les que
     # TODO: faci menys de X que estan donades de baixa?
     search_params = [('etag', '!=', False)]
     if contracts:
         search_params.append(('name', 'in', contracts))
+    if since:
+        logger.info(u"Cercant corbes modificades des de: %s", since)
+        search_params.append(
+            ('cups', 'in', get_changed_curve_cups(c, since))
+        )
     pids = c.GiscedataPolissa.search(search_params, context={'active_test': False})
     fields_to_read = ['name', 'cups', 'empowering_last_profile_measure', 'data_alta', 'data_baixa']
+    polisses = c.GiscedataPolissa.read(pids, fields_to_read)
+    if WATERMARKS_CONFIG['journal']:
+        watermarks = PROFILES_WATERMARKS.get_many(
+            p['cups'][1][:20] for p in polisses
+        )
+        for polissa in polisses:
+            polissa['empowering_last_profile_measure'] = max(
+                polissa['empowering_last_profile_measure'],
+                watermarks.get(polissa['cups'][1][:20])
+            )
+    if bulk:
+        skipped = enqueue_profiles_bulk(
+            c, polisses, bucket, force, bulk, payload
+        )
+        if not contracts:
+            cursor.advance(scan_start, skipped)
+        return
     from tqdm import tqdm
-    for polissa in tqdm(c.GiscedataPolissa.read(pids, fields_to_read)):
-        last_measure = polissa.get('empowering_last_profile_measure')
-        cups = polissa['cups'][1]
-        if not last_measure or force:
-            logger.info("Les pugem totes")
-            from_date = (
-                datetime.now() - relativedelta(years=3)
-            ).strftime('%Y-%m-%d')
-            from_date = max(polissa['data_alta'], from_date)
-            from_date = '{} 01:00:00'.format(from_date)
-        else:
-            from_date = last_measure
-        if polissa['data_baixa']:
-            to_date = (
-                datetime.strptime(polissa['data_baixa'], '%Y-%m-%d') + relativedelta(days=1)
-            ).strftime('%Y-%m-%d 00:00:00')
-        else:
-            to_date = ''
+    skipped = 0
+    for polissa in tqdm(polisses):
+        from_date, to_date = get_profiles_dates(polissa, force)
         logger.info(u"Pujant des de: %s fins a %s", from_date, to_date)
         # Use TM also
         for collection in ['tg.cchfact', 'tg.f1']:
-            model = c.model(collection)
-            cups_names = model.get_curve_cups(cups)
-            search_profiles = [
-                ('name', 'in', cups_names),
-                ('datetime', '>', from_date)
-            ]
-            if polissa['data_baixa']:
-                search_profiles += [
-                    ('datetime', '<=', to_date)
-                ]
-            measures = model.search(search_profiles)
-            logger.info("S'han trobat %s mesures (%s) per pujar", 
-                len(measures), collection
+            if not claim_profiles(collection, [polissa['name']]):
+                skipped += 1
+                continue
+            try:
+                n_profiles = enqueue_contract_profiles(
+                    c, collection, polissa, from_date, to_date, bucket,
+                    payload
+                )
+            finally:
+                release_profiles(collection, [polissa['name']])
+            logger.info("S'han trobat %s mesures (%s) per pujar",
+                n_profiles, collection
             )
-            popper = Popper(measures)
-            pops = popper.pop(bucket)
-            while pops:
-                j = push_amon_profiles.delay(pops, collection)
-                logger.info("Job id:%s | %s/%s/%s" % (
-                    j.id, polissa['name'], len(pops), len(popper.items))
+    if not contracts:
+        cursor.advance(scan_start, skipped)
+
+
+def enqueue_contract_profiles(c, collection, polissa, from_date, to_date,
+                              bucket, payload=False):
+    """Enqueue the profiles of `collection` of one contract between the
+    dates.
+
+    Returns the number of profiles enqueued.
+    """
+    model = c.model(collection)
+    search_profiles = cups_prefix_domain('name', [polissa['cups'][1]]) + [
+        ('datetime', '>', from_date)
+    ]
+    if polissa['data_baixa']:
+        search_profiles += [
+            ('datetime', '<=', to_date)
+        ]
+    buckets = search_pages(model, search_profiles, bucket, PROFILES_ORDER)
+    if payload:
+        buckets = read_profiles_pages(model, buckets)
+    return enqueue_profiles_ids(
+        buckets, collection, polissa['name'], payload
+    )
+
+
+def enqueue_profiles_bulk(c, polisses, bucket=500, force=False, bulk=100,
+                          payload=False):
+    """Enqueue profiles searching them for groups of `bulk` contracts.
+
+    The curves of the contracts are matched by the 20 characters of their
+    CUPS, read with the contracts, as when enqueuing one by one. One search
+    and one read of `PROFILE_FIELDS` is done per page of the group, then
+    the profiles are split back per contract and enqueued as soon as a
+    bucket is full.
+
+    Returns the number of contracts and collections skipped because they
+    have pending jobs.
+    """
+    skipped = 0
+    for group in chunks(polisses, bulk):
+        logger.info(u"Cercant %s contractes", len(group))
+        for collection in ['tg.cchfact', 'tg.f1']:
+            claimed = claim_profiles(collection, [p['name'] for p in group])
+            skipped += len(group) - len(claimed)
+            if not claimed:
+                continue
+            try:
+                # 20 characters CUPS -> [(contract name, from_date, to_date)]
+                windows = {}
+                for polissa in group:
+                    if polissa['name'] not in claimed:
+                        continue
+                    from_date, to_date = get_profiles_dates(polissa, force)
+                    windows.setdefault(polissa['cups'][1][:20], []).append(
+                        (polissa['name'], from_date, to_date)
+                    )
+                n_profiles = enqueue_windows_profiles(
+                    c, collection, windows, bucket, payload
                 )
-                pops = popper.pop(bucket)
+            finally:
+                release_profiles(collection, claimed)
+            logger.info("S'han trobat %s mesures (%s) per pujar",
+                n_profiles, collection
+            )
+    return skipped
 
 
-def enqueue_measures(bucket=500, contracts=None, force=False):
+def profiles_windows_domain(windows):
+    """Search domain of the profiles in the `windows` of the contracts.
+
+    The CUPS with the same window share a term, so the contracts synced up
+    to different dates are not searched from the oldest one.
+    """
+    cups_by_window = {}
+    for cups, cups_windows in windows.items():
+        for _, from_date, to_date in cups_windows:
+            cups_by_window.setdefault((from_date, to_date), set()).add(cups)
+    domain = ['|'] * (len(cups_by_window) - 1)
+    for (from_date, to_date), cups in sorted(cups_by_window.items()):
+        terms = [('datetime', '>', from_date)]
+        if to_date:
+            terms.append(('datetime', '<=', to_date))
+        domain += ['&'] * len(terms) + cups_prefix_domain('name', cups)
+        domain += terms
+    return domain
+
+
+def enqueue_windows_profiles(c, collection, windows, bucket, payload=False):
+    """Enqueue the profiles of `collection` in the `windows` of the
+    contracts searching them all at once.
+
+    Returns the number of profiles enqueued.
+    """
+    if not windows:
+        return 0
+    model = c.model(collection)
+    search_profiles = profiles_windows_domain(windows)
+    pending = {}
+    n_profiles = 0
+    pages = search_pages(model, search_profiles, bucket * 10, PROFILES_ORDER)
+    for profiles in read_profiles_pages(model, pages):
+        for profile in profiles:
+            # A CUPS can belong to several contracts of the group
+            for contract_name, p_from, p_to in windows[profile['name'][:20]]:
+                if profile['datetime'] <= p_from:
+                    continue
+                if p_to and profile['datetime'] > p_to:
+                    continue
+                contract_measures = pending.setdefault(contract_name, [])
+                contract_measures.append(
+                    payload and profile or profile['id']
+                )
+                if len(contract_measures) == bucket:
+                    n_profiles += enqueue_profiles_ids(
+                        [pending.pop(contract_name)], collection,
+                        contract_name, payload
+                    )
+    for contract_name, contract_measures in pending.items():
+        n_profiles += enqueue_profiles_ids(
+            [contract_measures], collection, contract_name, payload
+        )
+    return n_profiles
+
+
+def enqueue_measures(bucket=500, contracts=None, force=False,
+                     incremental=False, target_seconds=None):
+    """Enqueue the measures of the meters of the contracts with etag.
+
+    If `incremental` is set only the meters with readings changed since the
+    last scan are checked. The `bucket` is adapted to the previous jobs, see
+    `bucket_size`.
+    """
     # First get all the contracts that are in sync
     c = setup_peek()
+    bucket = bucket_size('push_amon_measures', bucket, target_seconds)
+    cursor = ScanCursor('measures')
+    scan_start = cursor.now()
+    since = incremental and not contracts and cursor.get()
     search_params = [('etag', '!=', False)]
     if contracts:
         search_params.append(('name', 'in', contracts))
     pids = c.GiscedataPolissa.search(search_params, context={'active_test': False})
     # Comptadors que tingui aquesta pòlissa i que siguin de telegestió
-    cids = c.GiscedataLecturesComptador.search([
-        ('polissa', 'in', pids)
-    ], context={'active_test': False})
+    search_params = [('polissa', 'in', pids)]
+    if since:
+        logger.info(u"Cercant lectures modificades des de: %s", since)
+        lectures_obj = c.GiscedataLecturesLectura
+        search_params.append(('id', 'in', read_related_ids(
+            lectures_obj, search_changed(lectures_obj, since), 'comptador'
+        )))
+    cids = c.GiscedataLecturesComptador.search(
+        search_params, context={'active_test': False}
+    )
     fields_to_read = ['name', 'empowering_last_measure']
+    watermarks = {}
+    if WATERMARKS_CONFIG['journal']:
+        watermarks = MEASURES_WATERMARKS.get_many(cids)
+    skipped = 0
     for comptador in c.GiscedataLecturesComptador.read(cids, fields_to_read):
-        last_measure = comptador.get('empowering_last_measure')
+        last_measure = max(
+            comptador.get('empowering_last_measure'),
+            watermarks.get(comptador['id'])
+        )
         if not last_measure or force:
             # Pujar totes
             logger.info("Les pugem totes")
@@ -122,57 +504,124 @@ def enqueue_measures(bucket=500, contracts=None, force=False):
         else:
             logger.info(u"Última lectura trobada: %s" % last_measure)
             from_date = last_measure
-        measures = c.GiscedataLecturesComptador.get_aggregated_measures(
-            [comptador['id']], from_date
-        )
-        logger.info("S'han trobat %s mesures per pujar" % (
-            len(measures)
-        ))
-        popper = Popper(measures)
-        pops = popper.pop(bucket)
-        while pops:
-            j = push_amon_measures.delay(pops)
-            logger.info("Job id:%s | %s/%s/%s" % (
-                j.id, comptador['name'], len(pops), len(popper.items))
+        # The measures of a meter are not enqueued again until all its
+        # jobs are done
+        if not claim('measures', [comptador['id']]):
+            skipped += 1
+            continue
+        try:
+            measures = c.GiscedataLecturesComptador.get_aggregated_measures(
+                [comptador['id']], from_date
             )
-            pops = popper.pop(bucket)
+            logger.info("S'han trobat %s mesures per pujar" % (
+                len(measures)
+            ))
+            for pops in chunks(measures, bucket):
+                j = delay_claimed(
+                    push_amon_measures, 'measures', comptador['id'], pops
+                )
+                logger.info("Job id:%s | %s/%s/%s" % (
+                    j.id, comptador['name'], len(pops), len(measures))
+                )
+        finally:
+            release('measures', [comptador['id']])
+    if not contracts:
+        cursor.advance(scan_start, skipped)
 
 
-def enqueue_new_contracts(bucket=1, force=False):
+def flush_watermarks():
+    """Write the watermarks of the journal back to the ERP.
+    """
+    c = setup_peek()
+
+    def write_measures(watermarks):
+        meters = {}
+        for meter_id, last_measure in watermarks.items():
+            meters.setdefault(last_measure, []).append(meter_id)
+        for last_measure, meter_ids in sorted(meters.items()):
+            c.GiscedataLecturesComptador.update_empowering_last_measure(
+                sorted(meter_ids), last_measure
+            )
+
+    n_measures = MEASURES_WATERMARKS.flush(write_measures)
+    n_profiles = PROFILES_WATERMARKS.flush(
+        lambda watermarks: write_last_profile_measures(c, watermarks)
+    )
+    logger.info('Flushed %s meters and %s CUPS watermarks',
+                n_measures, n_profiles)
+    return n_measures, n_profiles
+
+
+def enqueue_new_contracts(bucket=1, force=False, target_seconds=None):
+    bucket = bucket_size('push_contracts', bucket, target_seconds)
     search_params = [
         ('etag', '=', False),
         ('state', 'not in', ('esborrany', 'validar', 'cancelada'))
     ]
     if not force:
-        with setup_empowering_api() as em:
-            items = em.contracts().get(sort="[('_updated', -1)]")['_items']
-            if items:
-                from_date = make_local_timestamp(items[0]['_updated'])
-                search_params += [
-                        '|',
-                        ('create_date', '>', from_date),
-                        ('write_date', '>', from_date)
-                ]
+        em = get_empowering_api()
+        items = em.contracts().get(sort="[('_updated', -1)]")['_items']
+        if items:
+            from_date = make_local_timestamp(items[0]['_updated'])
+            search_params += [
+                    '|',
+                    ('create_date', '>', from_date),
+                    ('write_date', '>', from_date)
+            ]
     O = setup_peek()
     contracts_ids = O.GiscedataPolissa.search(search_params)
     logger.info('Found %s contracts to push', len(contracts_ids))
-    popper = Popper(contracts_ids)
-    pops = popper.pop(bucket)
-    while pops:
-        j = push_contracts.delay(pops)
+    for pops in chunks(contracts_ids, bucket):
+        # Contracts with a pending push are left to that job
+        pops = claim('contracts', pops)
+        if not pops:
+            continue
+        j = push_contracts.delay(
+            pops, dedup_claims=hand_over('contracts', pops)
+        )
         logger.info("Job id:%s" % j.id)
-        pops = popper.pop(bucket)
 
 
-def enqueue_contracts(contracts=None, force=False):
+def get_changed_contracts(O, since):
+    """Return the ids of the contracts changed after `since`.
+
+    A contract is changed if it, one of its meters or one of its modcons
+    was created or written.
+    """
+    changed = set(search_changed(O.GiscedataPolissa, since))
+    for model, field in [(O.GiscedataLecturesComptador, 'polissa'),
+                         (O.GiscedataPolissaModcontractual, 'polissa_id')]:
+        changed.update(read_related_ids(
+            model, search_changed(model, since), field
+        ))
+    return sorted(changed)
+
+
+def enqueue_contracts(contracts=None, force=False, workers=1,
+                      incremental=False):
+    """Enqueue the contracts updated after their last push.
+
+    With `workers` > 1 the contracts are checked in shards by a pool of
+    processes, each one with its own ERP client. If `incremental` is set
+    only the contracts changed since the last scan are checked.
+    """
     O = setup_peek()
+    cursor = ScanCursor('contracts')
+    scan_start = cursor.now()
+    since = incremental and contracts is None and cursor.get()
     # Busquem els que hem d'actualitzar
     if contracts is None:
-        polisses_actives_ids = O.GiscedataPolissa.search([
+        search_params = []
+        if since:
+            logger.info(u"Cercant contractes modificats des de: %s", since)
+            search_params.append(
+                ('id', 'in', get_changed_contracts(O, since))
+            )
+        polisses_actives_ids = O.GiscedataPolissa.search(search_params + [
             ('state', 'not in', ('esborrany', 'validar', 'cancelada')), ('contract_type', '=', '01')
         ])
         date_ago = (datetime.now() - relativedelta(months=3)).strftime('%Y-%m-%d')
-        polisses_baixes_ids = O.GiscedataPolissa.search([
+        polisses_baixes_ids = O.GiscedataPolissa.search(search_params + [
             ('state', '=', 'baixa'),
             ('data_baixa', '>=', date_ago)
         ], context={'active_test': False})
@@ -183,62 +632,141 @@ def enqueue_contracts(contracts=None, force=False):
         ], context={'active_test': False})
     if not polisses_ids:
         logger.info('No contracts found')
+        if contracts is None:
+            cursor.set(scan_start)
         return
-    fields_to_read = ['name', 'etag', 'comptadors', 'modcontractual_activa']
     if force:
         logger.info('Forcing pushing {} contracts'.format(len(polisses_ids)))
+        skipped = 0
         for polissa_id in polisses_ids:
-            push_contracts.delay([polissa_id])
+            if not delay_once(push_contracts, 'contracts', polissa_id,
+                              [polissa_id]):
+                skipped += 1
+        if contracts is None:
+            cursor.advance(scan_start, skipped)
         return
-    for polissa in O.GiscedataPolissa.read(polisses_ids, fields_to_read):
-        modcons = []
-        is_new_contract = False
+    names = contracts
+    if since:
+        # Only the state of the changed contracts is needed
+        names = [p['name'] for p in O.GiscedataPolissa.read(
+            polisses_ids, ['name']
+        )]
+    states = get_contracts_state(get_empowering_api(), names)
+    if workers > 1:
+        from multiprocessing import Pool
+        shard_size = max(1, len(polisses_ids) // (workers * 4))
+        pool = Pool(workers, init_contracts_shard, (states, ))
         try:
-            with setup_empowering_api() as em:
-                last_updated = em.contract(polissa['name']).get()['_updated']
-                last_updated = make_local_timestamp(last_updated)
-                etag_beedata = em.contract(polissa['name']).get()['_etag']
-                # Update etag in ERP if it changed
-                if etag_beedata != polissa['etag']:
-                    logger.info('Contract {} changed "etag". Resynced "etag" from API.'.format(polissa['name']))
-                    O.GiscedataPolissa.write(polissa['id'], {'etag': etag_beedata})
-        except (libsaas.http.HTTPError, urllib2.HTTPError) as e:
-            # A 404 is possible if we delete empowering contracts in insight engine
-            # but keep etag in our database.
+            shards = pool.map(
+                get_contracts_to_push_shard, chunks(polisses_ids, shard_size)
+            )
+        finally:
+            pool.close()
+            pool.join()
+        to_push = [pid for shard in shards for pid in shard]
+    else:
+        to_push = get_contracts_to_push(O, polisses_ids, states)
+    logger.info('Found %s contracts to push', len(to_push))
+    pushed = set()
+    skipped = 0
+    for polissa_id in to_push:
+        if polissa_id in pushed:
+            continue
+        pushed.add(polissa_id)
+        if not delay_once(push_contracts, 'contracts', polissa_id,
+                          [polissa_id]):
+            skipped += 1
+    if contracts is None:
+        cursor.advance(scan_start, skipped)
+
+
+def get_write_dates(model, ids, chunk=5000):
+    """Return {id: write_date} of `ids` with one perm_read per chunk.
+    """
+    write_dates = {}
+    for ids_chunk in chunks(list(ids), chunk):
+        for perm in model.perm_read(ids_chunk):
+            write_dates[perm['id']] = perm['write_date']
+    return write_dates
+
+
+def init_contracts_shard(states):
+    global _SHARD_STATES
+    _SHARD_STATES = states
+    # Don't share the connections inherited from the parent process
+    reset_clients()
+
+
+def get_contracts_to_push_shard(polisses_ids):
+    return get_contracts_to_push(get_peek(), polisses_ids, _SHARD_STATES)
+
+
+def get_contracts_to_push(O, polisses_ids, states):
+    """Return the ids of the contracts updated after their last push.
+
+    `states` are the contracts state in Empowering, as returned by
+    `get_contracts_state`. The write dates are read with one perm_read per
+    model.
+    """
+    fields_to_read = [
+        'name', 'etag', 'comptadors', 'modcontractual_activa',
+        'modcontractuals_ids'
+    ]
+    polisses = O.GiscedataPolissa.read(polisses_ids, fields_to_read)
+    w_dates = get_write_dates(O.GiscedataPolissa, polisses_ids)
+    c_w_dates = get_write_dates(O.GiscedataLecturesComptador, set(
+        c_id for polissa in polisses for c_id in polissa['comptadors']
+    ))
+    last_updates = {}
+    to_check_modcons = []
+    to_push = []
+    for polissa in polisses:
+        state = states.get(polissa['name'])
+        if not state:
+            # A contract is not found if we delete empowering contracts in
+            # insight engine but keep etag in our database.
             # In this case we must force the re-upload as new contract
-            if e.code != 404:
-                raise e
-            is_new_contract = True
-            last_updated = '0'
-
-        w_date = O.GiscedataPolissa.perm_read(polissa['id'])[0]['write_date']
-        c_w_dates = []
-        for comp_perm in O.GiscedataLecturesComptador.perm_read(polissa['comptadors']):
-            c_w_dates.append(comp_perm['write_date'])
-        c_w_date = max(c_w_dates)
-        if w_date > last_updated and not is_new_contract:
+            logger.info("La polissa %s te etag pero ha estat borrada "
+                        "d'empowering, es torna a pujar" % polissa['name'])
+            to_push.append(polissa['id'])
+            continue
+        last_updated = make_local_timestamp(state['_updated'])
+        # Update etag in ERP if it changed
+        if state['_etag'] != polissa['etag']:
+            logger.info('Contract {} changed "etag". Resynced "etag" from API.'.format(polissa['name']))
+            O.GiscedataPolissa.write(polissa['id'], {'etag': state['_etag']})
+        w_date = w_dates[polissa['id']]
+        c_w_date = max([c_w_dates[c_id] for c_id in polissa['comptadors']] or [False])
+        if w_date > last_updated:
             # Ara mirem quines modificaciones contractuals hem de pujar
-            polissa = O.GiscedataPolissa.browse(polissa['id'])
-            for modcon in polissa.modcontractuals_ids:
-                perms = modcon.perm_read()
-                if perms['write_date'] > last_updated:
-                    logger.info('La modcontractual %s a actualitzar write_'
-                                'date: %s last_update: %s' % (
-                        modcon.name, perms['write_date'], last_updated))
-                    modcons.append(modcon.id)
-        elif c_w_date > last_updated and not is_new_contract:
+            last_updates[polissa['id']] = (last_updated, w_date)
+            to_check_modcons.append(polissa)
+        elif c_w_date > last_updated:
             # Si no hi ha hagut canvis a les modificacions contractuals
             # però sí que s'ha tocat algun comptador fem una actualització
             # amb la última modificació contractual
-            modcons.append(polissa['modcontractual_activa'][0])
+            logger.info('Polissa %s actualitzada a %s després de %s' % (
+                polissa['name'], c_w_date, last_updated))
+            to_push.append(polissa['id'])
+    m_w_dates = get_write_dates(O.GiscedataPolissaModcontractual, set(
+        m_id for polissa in to_check_modcons
+        for m_id in polissa['modcontractuals_ids']
+    ))
+    for polissa in to_check_modcons:
+        last_updated, w_date = last_updates[polissa['id']]
+        modcons = [
+            m_id for m_id in polissa['modcontractuals_ids']
+            if m_w_dates[m_id] > last_updated
+        ]
+        for m_id in modcons:
+            logger.info('La modcontractual %s a actualitzar write_'
+                        'date: %s last_update: %s' % (
+                m_id, m_w_dates[m_id], last_updated))
         if modcons:
             logger.info('Polissa %s actualitzada a %s després de %s' % (
-                polissa.name, w_date, last_updated))
-            push_contracts.delay(polissa.id)
-        if is_new_contract:
-            logger.info("La polissa %s te etag pero ha estat borrada "
-                        "d'empowering, es torna a pujar" % polissa['name'])
-            push_contracts.delay([polissa['id']])
+                polissa['name'], w_date, last_updated))
+            to_push.append(polissa['id'])
+    return to_push
 
 
 def enqueue_indexed(bucket=1, force=False, pricelist=False, wreport=False):
@@ -326,93 +854,122 @@ def enqueue_indexed(bucket=1, force=False, pricelist=False, wreport=False):
 
 @job(setup_queue(name='measures'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
+@release_dedup
 def push_amon_measures(measures):
     """Pugem les mesures a l'Insight Engine
     """
     logging.basicConfig(level=logging.INFO)
-    with setup_empowering_api() as em:
-        c = setup_peek()
-        amon = AmonConverter(c)
-        start = datetime.now()
+    em = instrument_api(get_empowering_api())
+    c = instrument_erp(get_peek())
+    amon = AmonConverter(c)
+    count_items(len(measures))
+    with phase('convert'):
         measures_to_push = amon.aggregated_measures_to_amon(measures)
-        logger.info("Enviant de %s (id:%s) a %s (id:%s)" % (
-            measures[-1]['timestamp'], measures[-1]['meter_id'],
-            measures[0]['timestamp'], measures[0]['meter_id']
-        ))
-        stop = datetime.now()
-        logger.info('Mesures transformades en %s' % (stop - start))
-        start = datetime.now()
-        # Check which endpoint to use
+    first_measure = min(measures, key=lambda m: m['timestamp'])
+    last_measure = max(measures, key=lambda m: m['timestamp'])
+    logger.info("Enviant de %s (id:%s) a %s (id:%s)" % (
+        first_measure['timestamp'], first_measure['meter_id'],
+        last_measure['timestamp'], last_measure['meter_id']
+    ))
+    # Check which endpoint to use
+    pushed = True
+    with phase('upload'):
         residential = measures_to_push.get('R')
         if residential:
             logger.debug('Pushing %s', residential)
-            em.residential_timeofuse_amon_measures().create(residential)
+            items = create_documents(
+                em.residential_timeofuse_amon_measures, residential
+            )
+            for amon_data, item in zip(residential, items):
+                pushed &= check_response(item, amon_data)
         tertiary = measures_to_push.get('T')
         if tertiary:
-            logger.debug('Pushing %s', residential)
-            em.tertiary_amon_measures().create(tertiary)
-        # Save last timestamp
-        last_measure = measures[0]
-        c.GiscedataLecturesComptador.update_empowering_last_measure(
-            [last_measure['meter_id']], last_measure['timestamp']
-        )
-        stop = datetime.now()
-        logger.info('Mesures enviades en %s' % (stop - start))
-        logger.info("%s measures creades" % len(measures))
+            logger.debug('Pushing %s', tertiary)
+            items = create_documents(em.tertiary_amon_measures, tertiary)
+            for amon_data, item in zip(tertiary, items):
+                pushed &= check_response(item, amon_data)
+    # Save last timestamp only if everything was pushed
+    if pushed:
+        with phase('write-back'):
+            if WATERMARKS_CONFIG['journal']:
+                MEASURES_WATERMARKS.advance({
+                    last_measure['meter_id']: last_measure['timestamp']
+                })
+            else:
+                c.GiscedataLecturesComptador.update_empowering_last_measure(
+                    [last_measure['meter_id']], last_measure['timestamp']
+                )
+    logger.info("%s measures creades" % len(measures))
 
 
 @job(setup_queue(name='profiles'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
+@release_dedup
 def push_amon_profiles(profiles, collection):
     """Pugem les mesures a l'Insight Engine
+
+    `profiles` is a list of ids or a payload built with `encode_profiles`.
     """
-    with setup_empowering_api() as em:
-        c = setup_peek()
-        amon = AmonConverter(c)
-        measures_to_push = amon.profiles_to_amon(profiles, collection)
-        for cups, m_to_push in measures_to_push.items():
-            em.amon_measures().create(m_to_push)
-            last_measure = max(
-                make_local_timestamp(x['timestamp'])
-                for x in m_to_push['measurements']
-            )
-            pol_id = c.GiscedataPolissa.search([
-                ('cups.name', 'like', cups),
-                ('state', 'not in', ('esborrany', 'validar', 'cancelada', 'baixa')),
-                ('data_alta', '<=', last_measure),
-                '|',
-                ('data_baixa', '>=', last_measure),
-                ('data_baixa', '=', False)
-            ], context={'active_test': False})
-            if not pol_id:
-                continue
-            if len(pol_id) > 1:
-                raise Exception('{} contracts found! CUPS: {}. Last measure: {}'.format(len(pol_id), cups, last_measure))
-            pol = c.GiscedataPolissa.read(pol_id[0], ['name', 'empowering_last_profile_measure'])
-            if last_measure > pol['empowering_last_profile_measure']:
-                logger.info('Updating polissa (id: %s) to last measure: %s', pol['name'], last_measure)
-                c.GiscedataPolissa.write(pol_id, {
-                    'empowering_last_profile_measure': last_measure
-                })
+    em = instrument_api(get_empowering_api())
+    c = instrument_erp(get_peek())
+    amon = AmonConverter(c)
+    if isinstance(profiles, basestring):
+        profiles = decode_profiles(profiles)
+        with phase('convert'):
+            measures_to_push = amon.profile_rows_to_amon(profiles, collection)
+    else:
+        with phase('fetch'):
+            profiles = c.model(collection).read(profiles, PROFILE_FIELDS)
+        with phase('convert'):
+            measures_to_push = amon.profile_rows_to_amon(profiles, collection)
+    count_items(len(profiles))
+    measures_to_push = measures_to_push.items()
+    with phase('upload'):
+        items = create_documents(
+            em.amon_measures, [m_to_push for _, m_to_push in measures_to_push]
+        )
+    last_measures = {}
+    for (cups, m_to_push), item in zip(measures_to_push, items):
+        if not check_response(item, m_to_push):
+            continue
+        last_measures[cups] = max(
+            make_local_timestamp(x['timestamp'])
+            for x in m_to_push['measurements']
+        )
+    with phase('write-back'):
+        if WATERMARKS_CONFIG['journal']:
+            watermarks = {}
+            for cups, last_measure in last_measures.items():
+                watermarks[cups[:20]] = max(
+                    last_measure, watermarks.get(cups[:20])
+                )
+            PROFILES_WATERMARKS.advance(watermarks)
+        else:
+            update_last_profile_measures(c, last_measures)
 
 
 @job(setup_queue(name='contracts'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
 def push_modcontracts(modcons, etag):
     """modcons is a list of modcons to push
     """
-    em = setup_empowering_api()
-    O = setup_peek()
+    em = instrument_api(get_empowering_api())
+    O = instrument_erp(get_peek())
     amon = AmonConverter(O)
     fields_to_read = ['data_inici', 'polissa_id']
     modcons = O.GiscedataPolissaModcontractual.read(modcons, fields_to_read)
     modcons = sorted_by_key(modcons, 'data_inici')
     for modcon in modcons:
-        amon_data = amon.contract_to_amon(
-            modcon['polissa_id'][0],
-            {'modcon_id': modcon['id']}
-        )[0]
-        response = em.contract(modcon['polissa_id'][1]).update(amon_data, etag)
+        with phase('convert'):
+            amon_data = amon.contract_to_amon(
+                modcon['polissa_id'][0],
+                {'modcon_id': modcon['id']}
+            )[0]
+        with phase('upload'):
+            response = em.contract(modcon['polissa_id'][1]).update(amon_data, etag)
         if check_response(response, amon_data):
             etag = response['_etag']
     O.GiscedataPolissa.write(modcon['polissa_id'][0], {'etag': etag})
@@ -420,38 +977,76 @@ def push_modcontracts(modcons, etag):
 
 @job(setup_queue(name='contracts'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
+@release_dedup
 def push_contracts(contracts_id):
     """Pugem els contractes
     """
     import logging
     logging.basicConfig(level=logging.INFO)
-    with setup_empowering_api() as em:
-        O = setup_peek()
-        amon = AmonConverter(O)
-        if not isinstance(contracts_id, (list, tuple)):
-            contracts_id = [contracts_id]
-        for pol in O.GiscedataPolissa.read(contracts_id, ['name', 'etag']):
-            amon_data = amon.contract_to_amon(pol['id'])[0]
-            logger.debug('Contract data %s', amon_data)
-            try:
-                if pol['etag']:
-                    response = em.contract(pol['name']).update(
-                        amon_data, pol['etag']
-                    )
-                else:
-                    response = em.contracts().create(amon_data)
-            except urllib2.HTTPError as err:
-                raise Exception('HTTPError code {}. Error: {}'.format(err.code, err.read())) 
-            O.GiscedataPolissa.write([pol['id']], {'etag': response['_etag']})
+    em = instrument_api(get_empowering_api())
+    O = instrument_erp(get_peek())
+    amon = AmonConverter(O)
+    if not isinstance(contracts_id, (list, tuple)):
+        contracts_id = [contracts_id]
+    count_items(len(contracts_id))
+    to_push = []
+    with phase('convert'):
+        contracts_data = dict(
+            (amon_data['contractId'], amon_data)
+            for amon_data in amon.contract_to_amon(contracts_id)
+        )
+    with phase('fetch'):
+        polisses = O.GiscedataPolissa.read(contracts_id, ['name', 'etag'])
+    for pol in polisses:
+        amon_data = contracts_data.get(pol['name'])
+        if not amon_data:
+            logger.warning('Contract %s can not be converted', pol['name'])
+            continue
+        logger.debug('Contract data %s', amon_data)
+        to_push.append((pol, amon_data))
+
+    def upload(pol_data):
+        # Any error is returned, so the etags of the contracts already
+        # uploaded are written anyway
+        pol, amon_data = pol_data
+        try:
+            if pol['etag']:
+                response = em.contract(pol['name']).update(
+                    amon_data, pol['etag']
+                )
+            else:
+                response = em.contracts().create(amon_data)
+            return response['_etag'], None
+        except urllib2.HTTPError as err:
+            return None, Exception('HTTPError code {}. Error: {}'.format(err.code, err.read()))
+        except Exception as err:
+            logger.exception('Error uploading contract %s', pol['name'])
+            return None, err
+
+    with phase('upload'):
+        responses = concurrent_map(upload, to_push)
+    error = None
+    with phase('write-back'):
+        for (pol, _), (etag, err) in zip(to_push, responses):
+            if err:
+                error = error or err
+                continue
+            O.GiscedataPolissa.write([pol['id']], {'etag': etag})
+    if error:
+        raise error
 
 
 @job(setup_queue(name='tariffs'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
 def push_tariffs(tariffs):
-    c = setup_peek()
+    c = instrument_erp(get_peek())
     a = AmonConverter(c)
-    result = a.tariff_to_amon(*tariffs)
-    with setup_empowering_api() as em:
+    with phase('convert'):
+        result = a.tariff_to_amon(*tariffs)
+    em = instrument_api(get_empowering_api())
+    with phase('upload'):
         for r in result:
             try:
                 print(r)
@@ -463,21 +1058,25 @@ def push_tariffs(tariffs):
 
 @job(setup_queue(name='indexeds'), connection=setup_redis(), timeout=3600)
 @sentry.capture_exceptions
+@instrument_job
 def push_indexeds(indexeds):
     """Preus horaris indexats agrupats per llista de preu i FEE
     """
-    c = setup_peek()
+    c = instrument_erp(get_peek())
     a = AmonConverter(c)
-    result = a.indexed_to_amon(*indexeds)
-    with setup_empowering_api() as em:
-        try:
+    with phase('convert'):
+        result = a.indexed_to_amon(*indexeds)
+    em = instrument_api(get_empowering_api())
+    try:
+        with phase('upload'):
             response = em.price_indexed().create(result)
-            if response['_status'] == 'OK':
-                msg_ok = 'Grup indexats PUJAT CORRECTAMENT! %s', response
-                print(msg_ok)
-                logger.info(msg_ok)
-                # If a list is POSTed it will return an ordered list with documents
-                # with eve fields added
+        if response['_status'] == 'OK':
+            msg_ok = 'Grup indexats PUJAT CORRECTAMENT! %s', response
+            print(msg_ok)
+            logger.info(msg_ok)
+            # If a list is POSTed it will return an ordered list with documents
+            # with eve fields added
+            with phase('write-back'):
                 for item in response['_items']:
                     etag = item['_etag']
                     # First or last same tariffId and cost
@@ -499,6 +1098,6 @@ def push_indexeds(indexeds):
                             'empowering_price_indexed_last_push': ldate,
                             'etag': etag
                         })
-        except urllib2.HTTPError as err:
-            print(err.read())
-            raise
+    except urllib2.HTTPError as err:
+        print(err.read())
+        raise
@@ -0,0 +1,145 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+from functools import partial
+from multiprocessing.pool import ThreadPool
+import json
+import logging
+import urllib2
+
+import libsaas
+
+from .utils import config_from_environment
+
+
+logger = logging.getLogger('amon')
+
+# Upload threads, kept for the whole life of the worker
+_POOLS = {}
+
+# Codes of the documents rejected by the API validation, any other error
+# (session expired, server down...) fails the upload
+VALIDATION_CODES = (400, 422)
+
+
+def setup_upload(**kwargs):
+    """Upload settings, can be overridden with UPLOAD_* environment vars.
+    """
+    config = {
+        'max_documents': 50,
+        'max_bytes': 4 * 1024 * 1024,
+        'concurrency': 1
+    }
+    config.update(kwargs)
+    return config_from_environment('UPLOAD', **config)
+
+
+def batch_documents(documents, max_documents, max_bytes):
+    """Group `documents` in lists of at most `max_documents` documents and
+    `max_bytes` of JSON.
+
+    A document bigger than `max_bytes` is sent alone.
+    """
+    batch = []
+    size = 0
+    for document in documents:
+        document_size = len(json.dumps(document))
+        if batch and (len(batch) >= max_documents
+                      or size + document_size > max_bytes):
+            yield batch
+            batch = []
+            size = 0
+        batch.append(document)
+        size += document_size
+    if batch:
+        yield batch
+
+
+def response_items(response, n_documents):
+    """Return the status of every document of a POST response.
+
+    Posting a list returns one item per document in ``_items``, posting a
+    single document returns its status directly.
+    """
+    if '_items' in response:
+        return response['_items']
+    return [response] * n_documents
+
+
+def is_validation_error(error):
+    return getattr(error, 'code', None) in VALIDATION_CODES
+
+
+def error_item(error):
+    try:
+        issues = getattr(error, 'body', None) or error.read()
+    except Exception:
+        issues = str(error)
+    return {'_status': 'ERR', '_error': {'code': error.code}, '_issues': issues}
+
+
+def get_pool(size):
+    """Return a pool of `size` upload threads shared by the process.
+    """
+    if size not in _POOLS:
+        _POOLS[size] = ThreadPool(size)
+    return _POOLS[size]
+
+
+def concurrent_map(func, items, concurrency=None):
+    """Like `map` but running up to `concurrency` calls at the same time.
+
+    Intended for HTTP calls, ERP calls must stay in the calling thread.
+    """
+    if concurrency is None:
+        concurrency = setup_upload()['concurrency']
+    if concurrency <= 1 or len(items) <= 1:
+        return map(func, items)
+    return get_pool(concurrency).map(func, items)
+
+
+def create_batch(resource, batch):
+    """POST a `batch` of documents and return their status items.
+
+    If the API rejects the batch as invalid its documents are posted one by
+    one, so a wrong document doesn't hold back the others. Other errors are
+    raised.
+    """
+    try:
+        response = resource().create(batch)
+        return response_items(response, len(batch))
+    except (libsaas.http.HTTPError, urllib2.HTTPError) as e:
+        if not is_validation_error(e):
+            raise
+        if len(batch) == 1:
+            return [error_item(e)]
+        logger.warning(
+            'Batch of %s documents rejected (code: %s), pushing them '
+            'one by one', len(batch), e.code
+        )
+    items = []
+    for document in batch:
+        try:
+            items.append(resource().create(document))
+        except (libsaas.http.HTTPError, urllib2.HTTPError) as e:
+            if not is_validation_error(e):
+                raise
+            items.append(error_item(e))
+    return items
+
+
+def create_documents(resource, documents, **kwargs):
+    """POST `documents` to `resource` (``em.amon_measures`` style) packing
+    many of them in every request and sending up to ``concurrency``
+    requests at the same time.
+
+    Returns the status items in the same order as `documents`.
+    """
+    config = setup_upload(**kwargs)
+    batches = list(batch_documents(
+        documents, config['max_documents'], config['max_bytes']
+    ))
+    items = []
+    for batch_items in concurrent_map(partial(create_batch, resource),
+                                      batches, config['concurrency']):
+        items += batch_items
+    return items
@@ -4,11 +4,13 @@ from functools import partial
 import logging
 import os
 import re
+import threading
+import time
 from datetime import datetime, timedelta
 from copy import deepcopy
 
 from amoniak import VERSION
-from empowering import Empowering
+from amoniak.executors import KeepAliveEmpowering as Empowering
 import erppeek
 import pymongo
 import redis
@@ -21,6 +23,9 @@ logger = logging.getLogger(__name__)
 
 
 __REDIS_POOL = None
+__CLIENTS = {}
+# Seconds between health checks of the shared clients
+CLIENTS_CHECK_INTERVAL = 60
 __FIRST_CAP_RE = re.compile('(.)([A-Z][a-z]+)')
 __ALL_CAP_RE = re.compile('([a-z0-9])([A-Z])')
 
@@ -30,15 +35,112 @@ def lowercase(name):
     return __ALL_CAP_RE.sub(r'\1.\2', s1).lower()
 
 
-class Popper(object):
-    def __init__(self, items):
-        self.items = list(items)
-
-    def pop(self, n):
-        res = []
-        for x in xrange(0, min(n, len(self.items))):
-            res.append(self.items.pop())
-        return res
+def chunks(items, n):
+    """Yield successive lists of `n` elements from `items`.
+    """
+    for idx in xrange(0, len(items), n):
+        yield items[idx:idx + n]
+
+
+def read_by_id(model, ids, fields):
+    """Read `ids` of `model` with one call and return them keyed by id.
+    """
+    ids = sorted(set(x for x in ids if x))
+    if not ids:
+        return {}
+    return dict((record['id'], record) for record in model.read(ids, fields))
+
+
+def search_pages(model, search_params, limit, order='id', context=None):
+    """Yield the ids matching `search_params` in pages of `limit` ids.
+
+    Only one page is kept in memory, the `order` must be stable so the
+    pages don't overlap.
+    """
+    offset = 0
+    while True:
+        ids = model.search(search_params, offset, limit, order, context or {})
+        if ids:
+            yield ids
+        if len(ids) < limit:
+            break
+        offset += limit
+
+
+class LRUCache(object):
+    """Size bounded cache which discards the least recently used items.
+
+    If `ttl` is set the items also expire `ttl` seconds after being set.
+    Keeps `hits` and `misses` counters and is safe to use from threads.
+    """
+    _missing = object()
+
+    def __init__(self, maxsize=1024, ttl=None):
+        self.maxsize = maxsize
+        self.ttl = ttl
+        self.hits = 0
+        self.misses = 0
+        self._data = collections.OrderedDict()
+        self._lock = threading.Lock()
+
+    def __len__(self):
+        return len(self._data)
+
+    def __contains__(self, key):
+        return key in self._data
+
+    def get(self, key, default=None):
+        with self._lock:
+            try:
+                value, expires = self._data.pop(key)
+            except KeyError:
+                self.misses += 1
+                return default
+            if expires is not None and expires < time.time():
+                self.misses += 1
+                return default
+            self._data[key] = (value, expires)
+            self.hits += 1
+            return value
+
+    def set(self, key, value):
+        expires = None
+        if self.ttl is not None:
+            expires = time.time() + self.ttl
+        with self._lock:
+            self._data.pop(key, None)
+            self._data[key] = (value, expires)
+            if len(self._data) > self.maxsize:
+                self._data.popitem(last=False)
+
+    def get_or_set(self, key, func, *args):
+        """Return the cached value of `key` or cache ``func(*args)``.
+        """
+        value = self.get(key, self._missing)
+        if value is self._missing:
+            value = func(*args)
+            self.set(key, value)
+        return value
+
+    def delete(self, key):
+        with self._lock:
+            self._data.pop(key, None)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def info(self):
+        total = self.hits + self.misses
+        return {
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': total and float(self.hits) / total or 0.0,
+            'size': len(self._data),
+            'maxsize': self.maxsize
+        }
 
 
 class PoolWrapper(object):
@@ -108,6 +210,44 @@ def setup_peek(**kwargs):
     return erppeek.Client(**peek_config)
 
 
+def shared_client(name, setup, check, **kwargs):
+    """Return a client shared by the whole process.
+
+    The client is built with ``setup(**kwargs)`` the first time it's needed,
+    checked with ``check(client)`` at most every `CLIENTS_CHECK_INTERVAL`
+    seconds and built again if the check fails.
+    """
+    key = (name, tuple(sorted(kwargs.items())))
+    client, checked = __CLIENTS.get(key, (None, 0))
+    now = time.time()
+    if client is not None and now - checked > CLIENTS_CHECK_INTERVAL:
+        try:
+            check(client)
+            checked = now
+        except Exception as e:
+            logger.warning('Shared %s client failed (%s), reconnecting', name, e)
+            client = None
+    if client is None:
+        client = setup(**kwargs)
+        checked = now
+    __CLIENTS[key] = (client, checked)
+    return client
+
+
+def reset_clients():
+    """Drop the shared clients, next calls will build new ones.
+    """
+    __CLIENTS.clear()
+
+
+def check_peek(client):
+    client.search('res.users', [('id', '=', 1)])
+
+
+def get_peek(**kwargs):
+    return shared_client('peek', setup_peek, check_peek, **kwargs)
+
+
 def setup_mongodb(**kwargs):
     config = config_from_environment('MONGODB', ['host', 'database'], **kwargs)
     mongo = pymongo.MongoClient(host=config['host'])
@@ -120,6 +260,23 @@ def setup_empowering_api(**kwargs):
     return em
 
 
+def check_empowering_api(em):
+    """Raise if `em` can't reach the API, e.g. with an expired session.
+
+    Does a GET of the contracts matching nothing, the lightest request the
+    API answers.
+    """
+    if em.login_handler and not em.token:
+        raise Exception('Empowering session lost')
+    em.contracts().get(where='{"contractId": ""}')
+
+
+def get_empowering_api(**kwargs):
+    return shared_client(
+        'empowering', setup_empowering_api, check_empowering_api, **kwargs
+    )
+
+
 def setup_redis(**kwargs):
     global __REDIS_POOL
     config = config_from_environment('REDIS', [], **kwargs)
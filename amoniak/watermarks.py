@@ -0,0 +1,149 @@
+# -*- coding: utf-8 -*-
+"""Journal of the last pushed measures.
+
+With ``WATERMARKS_JOURNAL`` set the push jobs don't write their progress to
+the ERP: they advance a watermark per meter (measures) or per CUPS
+(profiles) in Redis, and `flush_watermarks` writes them back to the ERP in
+bulk. The enqueuers read the journal together with the ERP fields, which
+may be behind.
+
+The enqueuers also keep here the time of their last scan, so they can be run
+in incremental mode looking only at the records changed since then.
+"""
+from __future__ import absolute_import
+import logging
+from datetime import datetime, timedelta
+
+from .utils import config_from_environment, setup_redis
+
+
+logger = logging.getLogger('amon')
+
+
+def setup_watermarks(**kwargs):
+    config = {'journal': False}
+    config.update(kwargs)
+    return config_from_environment('WATERMARKS', **config)
+
+
+class WatermarkJournal(object):
+    """Watermarks stored in one Redis hash.
+
+    Values are ``%Y-%m-%d %H:%M:%S`` strings, so they are compared as
+    strings. The keys advanced since the last flush are kept in a set and
+    `key` converts them back from the strings stored in Redis.
+    """
+
+    def __init__(self, name, key=str):
+        self.name = 'amoniak:watermarks:{}'.format(name)
+        self.pending = '{}:pending'.format(self.name)
+        self.flushing = '{}:flushing'.format(self.name)
+        self.key = key
+
+    def advance(self, watermarks):
+        """Move the `watermarks` forward, older values are ignored.
+
+        Returns the watermarks that were advanced.
+        """
+        values = dict((str(k), v) for k, v in watermarks.items() if v)
+        advanced = {}
+        if not values:
+            return advanced
+
+        def update(pipe):
+            advanced.clear()
+            current = pipe.hmget(self.name, values.keys())
+            for (key, value), old in zip(values.items(), current):
+                if old is None or value > old:
+                    advanced[key] = value
+            pipe.multi()
+            if advanced:
+                pipe.hmset(self.name, advanced)
+                pipe.sadd(self.pending, *advanced.keys())
+
+        # Retried if another job changes the watermarks meanwhile
+        setup_redis().transaction(update, self.name)
+        return dict((self.key(k), v) for k, v in advanced.items())
+
+    def get_many(self, keys):
+        """Return a dict with the watermarks found for `keys`.
+        """
+        keys = list(set(keys))
+        if not keys:
+            return {}
+        values = setup_redis().hmget(self.name, [str(k) for k in keys])
+        return dict((k, v) for k, v in zip(keys, values) if v is not None)
+
+    def flush(self, writer):
+        """Write the pending watermarks with ``writer(watermarks)``.
+
+        `writer` returns a dict with the keys it couldn't write and why.
+        They are logged and dropped, the next flush writes them again only
+        if they advance. Keys advanced while flushing stay pending for the
+        next flush. If `writer` raises, all the keys being flushed are retried
+        on the next flush.
+
+        Returns the number of watermarks written.
+        """
+        conn = setup_redis()
+        pipe = conn.pipeline()
+        pipe.sunionstore(self.flushing, [self.flushing, self.pending])
+        pipe.delete(self.pending)
+        pipe.execute()
+        keys = list(conn.smembers(self.flushing))
+        if not keys:
+            return 0
+        values = conn.hmget(self.name, keys)
+        failed = writer(dict(
+            (self.key(k), v) for k, v in zip(keys, values) if v is not None
+        )) or {}
+        for key, reason in sorted(failed.items()):
+            logger.error('Watermark %s of %s not written: %s',
+                         key, self.name, reason)
+        conn.delete(self.flushing)
+        return len(keys) - len(failed)
+
+    def clear(self):
+        setup_redis().delete(self.name, self.pending, self.flushing)
+
+
+class ScanCursor(object):
+    """Time of the last scan of an enqueuer stored in Redis.
+
+    The time is taken when the scan starts, `overlap` seconds earlier so
+    the records written by the ERP meanwhile or with its clock a bit behind
+    are scanned again.
+    """
+
+    def __init__(self, name, overlap=300):
+        self.name = 'amoniak:cursor:{}'.format(name)
+        self.overlap = overlap
+
+    def get(self):
+        return setup_redis().get(self.name)
+
+    def now(self):
+        return (
+            datetime.now() - timedelta(seconds=self.overlap)
+        ).strftime('%Y-%m-%d %H:%M:%S')
+
+    def set(self, value):
+        setup_redis().set(self.name, value)
+        logger.info('Cursor %s saved: %s', self.name, value)
+
+    def advance(self, value, skipped=0):
+        """Save `value` unless `skipped` items of the scan were left to
+        pending jobs, which may have read them before they changed. The
+        next scan looks at them again.
+        """
+        if skipped:
+            logger.info('Cursor %s kept, %s items skipped', self.name, skipped)
+            return
+        self.set(value)
+
+
+WATERMARKS_CONFIG = setup_watermarks()
+# Meter id -> last measure pushed
+MEASURES_WATERMARKS = WatermarkJournal('measures', key=int)
+# 20 characters CUPS -> last profile pushed
+PROFILES_WATERMARKS = WatermarkJournal('profiles')
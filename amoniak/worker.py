@@ -0,0 +1,44 @@
+# -*- coding: utf-8 -*-
+from __future__ import absolute_import
+import logging
+
+from rq import Worker
+
+from .utils import reset_clients
+from .amon import utc_timestamps_info, uuids_info
+
+
+logger = logging.getLogger('amon')
+
+
+class SimpleWorker(Worker):
+    """Worker that performs the jobs in its own process.
+
+    The default RQ worker forks a work horse for every job, so everything
+    cached at module level (fields of the ERP models, clients, ...) is lost
+    after each job. This one keeps it for the whole life of the worker.
+
+    The shared ERP and Empowering clients are dropped when a job fails, so
+    the next job gets new ones.
+    """
+
+    def __init__(self, *args, **kwargs):
+        super(SimpleWorker, self).__init__(*args, **kwargs)
+        self.push_exc_handler(self.reset_clients)
+
+    def reset_clients(self, job, *exc_info):
+        reset_clients()
+        return True
+
+    def fork_and_perform_job(self, job):
+        self.perform_job(job)
+        self.log_caches()
+
+    def log_caches(self):
+        for name, info in (('UTC timestamps', utc_timestamps_info()),
+                           ('uuids', uuids_info())):
+            logger.debug('%s cache: %s entries, hit rate %.2f%%',
+                         name, info['size'], info['hit_rate'] * 100)
+
+    def execute_job(self, job, *args):
+        return self.perform_job(job, *args)
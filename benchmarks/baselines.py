@@ -0,0 +1,82 @@
+# -*- coding: utf-8 -*-
+"""Previous implementations of the optimized conversions, to benchmark
+them against the current ones.
+"""
+from __future__ import absolute_import
+import os
+from copy import deepcopy
+
+from empowering.utils import make_utc_timestamp, make_uuid
+
+
+def aggregated_measures_to_amon(measures):
+    """`AmonConverter.aggregated_measures_to_amon` copying the whole bucket
+    and converting the timestamp three times per measure.
+    """
+    res = {'R': [], 'T': []}
+
+    for m in deepcopy(measures):
+        values = {}
+        cups = m['cups']
+        # Check if CUPS must be informed with 20 characters
+        if int(os.getenv('CUPS_20_CHARACTERS', '0')):
+            cups = cups[:20]
+        for agg in m['measures']:
+            t = agg.pop('tipus')
+            values.setdefault(t, {})
+            values[t].update(agg)
+
+        measurements = {
+            'A': {
+                'timestamp': make_utc_timestamp(m['timestamp']),
+                'type': m['resource'] == 'R' and 'touElectricityConsumption' or 'tertiaryElectricityConsumption',
+                'values': values.get('A')
+            },
+            'R': {
+                'timestamp': make_utc_timestamp(m['timestamp']),
+                'type': m['resource'] == 'R' and 'touElectricityKiloVoltAmpHours' or 'tertiaryElectricityKiloVoltAmpHours',
+                'values': values.get('R')
+            },
+            'P': {
+                'timestamp': make_utc_timestamp(m['timestamp']),
+                'type': m['resource'] == 'R' and 'touPower' or 'tertiaryPower',
+                'values': values.get('P')
+            }
+        }
+        deviceId = make_uuid('giscedata.cups.ps', cups)
+        readings = []
+        if measurements['A']['values']:
+            readings.append({
+                "type": measurements['A']['type'],
+                "unit": "kWh",
+                "period": "INSTANT",
+            })
+        if measurements['R']['values']:
+            readings.append({
+                "type": measurements['R']['type'],
+                "unit": "kVArh",
+                "period": "INSTANT",
+            })
+        if measurements['P']['values']:
+            readings.append({
+                "type": measurements['P']['type'],
+                "unit": "kW",
+                "period": "INSTANT",
+            })
+        res[m['resource']].append({
+            'deviceId': deviceId,
+            'meteringPointId': deviceId,
+            'readings': readings,
+            'measurements': [v for v in measurements.values() if v['values']]
+        })
+    return res
+
+
+def truncate_cups(cups_names):
+    """Truncation of the CUPS reading ``CUPS_20_CHARACTERS`` for every row,
+    as the converters did before `setup_converter`.
+    """
+    return [
+        int(os.getenv('CUPS_20_CHARACTERS', '0')) and cups[:20] or cups
+        for cups in cups_names
+    ]
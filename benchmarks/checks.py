@@ -0,0 +1,169 @@
+# -*- coding: utf-8 -*-
+"""Checks that the optimized conversions give the same output as the plain
+ones.
+
+    $ python -m benchmarks.checks
+"""
+from __future__ import absolute_import
+import random
+import sys
+from datetime import datetime, timedelta
+
+import click
+
+from .fake_erp import FakeClient
+from .generators import cups_name
+
+
+def hourly_profiles(start, size, meters=1):
+    """`size` hourly profiles of `meters` meters from `start`.
+    """
+    profiles = []
+    for idx in range(size):
+        hour = start + timedelta(hours=idx // meters)
+        profiles.append({
+            'name': cups_name(idx % meters)[:20],
+            'datetime': hour.strftime('%Y-%m-%d %H:%M:%S'),
+            'ai': idx
+        })
+    return profiles
+
+
+def buckets():
+    """(description, profiles) of buckets crossing DST changes, unsorted and
+    with invalid dates.
+    """
+    spring = hourly_profiles(datetime(2023, 3, 25, 5), 1000)
+    autumn = hourly_profiles(datetime(2023, 10, 28, 1), 1200, meters=3)
+    unsorted = list(spring + autumn)
+    random.Random(1).shuffle(unsorted)
+    invalid = list(spring)
+    invalid[10] = dict(invalid[10], datetime='2023-03-26 25:00:00')
+    invalid[20] = dict(invalid[20], datetime=False)
+    return [
+        ('spring DST, one CUPS', spring),
+        ('autumn DST, three CUPS', autumn),
+        ('unsorted', unsorted),
+        ('invalid dates', invalid),
+    ]
+
+
+def convert(func, *args):
+    """Return the result of `func` or the class of the exception raised."""
+    try:
+        return func(*args)
+    except Exception as exc:
+        return exc.__class__
+
+
+def check_utc_timestamps():
+    """Compare `vectorized_utc_timestamps` with `utc_timestamp` on Series
+    with default, shuffled and offset indexes.
+    """
+    import pandas as pd
+    from amoniak.amon import utc_timestamp, vectorized_utc_timestamps
+    errors = []
+    for name, profiles in buckets():
+        datetimes = [p['datetime'] for p in profiles]
+        expected = convert(lambda: [utc_timestamp(x) for x in datetimes])
+        shuffled = list(range(len(datetimes)))
+        random.Random(2).shuffle(shuffled)
+        indexes = [
+            ('default index', None),
+            ('shuffled index', shuffled),
+            ('offset index', [idx + 500 for idx in range(len(datetimes))]),
+        ]
+        for index_name, index in indexes:
+            result = convert(vectorized_utc_timestamps, pd.Series(
+                datetimes, index=index, dtype=object
+            ))
+            if result != expected:
+                errors.append('{} ({}): {} differences'.format(
+                    name, index_name, isinstance(result, list) and sum(
+                        1 for a, b in zip(result, expected) if a != b
+                    ) or result
+                ))
+    return errors
+
+
+def check_profile_rows():
+    """Compare `profile_rows_to_amon_vectorized` with the row by row
+    conversion of `profile_rows_to_amon`.
+    """
+    from amoniak import amon
+    converter = amon.AmonConverter(FakeClient())
+    errors = []
+    min_profiles = amon.VECTORIZE_MIN_PROFILES
+    for name, profiles in buckets():
+        amon.VECTORIZE_MIN_PROFILES = sys.maxint
+        try:
+            expected = convert(converter.profile_rows_to_amon, profiles)
+        finally:
+            amon.VECTORIZE_MIN_PROFILES = min_profiles
+        result = convert(converter.profile_rows_to_amon_vectorized, profiles)
+        if result != expected:
+            errors.append('{}: different AMON measures'.format(name))
+    return errors
+
+
+def check_potencies():
+    """Compare the powers built by `read_potencies` from the contract
+    records with the ones of ``get_potencies_dict``.
+    """
+    from amoniak import amon
+    from .generators import make_contracts
+    client, contract_ids = make_contracts(10)
+    converter = amon.AmonConverter(client)
+    polisses = client.GiscedataPolissa.read(
+        contract_ids, ['potencies_periode']
+    )
+    errors = []
+    for polissa_id, powers in converter.read_potencies(polisses).items():
+        expected = client.GiscedataPolissa.get_potencies_dict(polissa_id)
+        if powers != expected:
+            errors.append('contract {}: {} != {}'.format(
+                polissa_id, powers, expected
+            ))
+    return errors
+
+
+def check_aggregated_measures():
+    """Compare `aggregated_measures_to_amon` with the previous implementation
+    copying the bucket.
+    """
+    from amoniak import amon
+    from . import baselines
+    from .generators import make_aggregated_measures
+    measures = make_aggregated_measures(500)
+    result = amon.AmonConverter(FakeClient()).aggregated_measures_to_amon(
+        measures
+    )
+    if result != baselines.aggregated_measures_to_amon(measures):
+        return ['different AMON measures']
+    return []
+
+
+CHECKS = [
+    ('vectorized_utc_timestamps', check_utc_timestamps),
+    ('profile_rows_to_amon_vectorized', check_profile_rows),
+    ('read_potencies', check_potencies),
+    ('aggregated_measures_to_amon', check_aggregated_measures),
+]
+
+
+@click.command()
+def main():
+    from .converters import use_fake_redis
+    use_fake_redis()
+    failed = False
+    for name, check in CHECKS:
+        errors = check()
+        for error in errors:
+            click.echo('{}: {}'.format(name, error), err=True)
+        click.echo('{}: {}'.format(name, errors and 'FAIL' or 'OK'), err=True)
+        failed |= bool(errors)
+    sys.exit(failed and 1 or 0)
+
+
+if __name__ == '__main__':
+    main()
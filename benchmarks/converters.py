@@ -0,0 +1,161 @@
+# -*- coding: utf-8 -*-
+"""Benchmarks of the AmonConverter methods with synthetic ERP data.
+
+    $ python -m benchmarks.converters --sizes 100,1000 --output results.json
+"""
+from __future__ import absolute_import
+import json
+import platform
+import sys
+import timeit
+from datetime import datetime
+
+import click
+
+from .generators import (
+    cups_name, make_aggregated_measures, make_contracts,
+    make_price_attachments, make_profile_records, make_reference_data
+)
+from .fake_erp import FakeClient
+
+
+def use_fake_redis():
+    """Make every Redis connection of amoniak use an in-memory Redis.
+
+    Must be called before importing `amoniak`, as RQ checks the class of the
+    connections and the jobs are bound to a connection when imported.
+    """
+    import fakeredis
+    import redis
+    redis.Redis = fakeredis.FakeRedis
+    redis.StrictRedis = fakeredis.FakeStrictRedis
+    return fakeredis.FakeRedis()
+
+
+def clear_caches():
+    from amoniak import amon, cache
+    amon.UTC_TIMESTAMPS.clear()
+    amon.UUIDS.clear()
+    amon.FIELDS_CACHE.clear()
+    cache.REFERENCE_CACHE.invalidate()
+
+
+def setup_profiles(size):
+    client, ids = make_profile_records(size)
+    return client, lambda amon: amon.profiles_to_amon(ids)
+
+
+def setup_aggregated_measures(size):
+    measures = make_aggregated_measures(size)
+    return FakeClient(), lambda amon: amon.aggregated_measures_to_amon(measures)
+
+
+def setup_aggregated_measures_deepcopy(size):
+    from .baselines import aggregated_measures_to_amon
+    measures = make_aggregated_measures(size)
+    return FakeClient(), lambda amon: aggregated_measures_to_amon(measures)
+
+
+def setup_cups_20_config(size):
+    names = [cups_name(idx) for idx in range(size)]
+
+    def run(amon):
+        cups_20 = amon.config['cups_20_characters']
+        return [cups_20 and cups[:20] or cups for cups in names]
+    return FakeClient(), run
+
+
+def setup_cups_20_getenv(size):
+    from .baselines import truncate_cups
+    names = [cups_name(idx) for idx in range(size)]
+    return FakeClient(), lambda amon: truncate_cups(names)
+
+
+def setup_contracts(size):
+    client, ids = make_contracts(size)
+    return client, lambda amon: amon.contract_to_amon(ids)
+
+
+def setup_tariffs(size):
+    client = FakeClient()
+    ref = make_reference_data(client)
+    tariffs = [ref['tariffs'][idx % len(ref['tariffs'])] for idx in range(size)]
+
+    def run(amon):
+        return [amon.tariff_to_amon(ref['pricelist'], t) for t in tariffs]
+    return client, run
+
+
+def setup_indexed(size):
+    client, ids = make_price_attachments(size)
+    return client, lambda amon: amon.indexed_to_amon(('2.0A', 'INDEXADA'), ids)
+
+
+BENCHMARKS = [
+    ('profiles_to_amon', setup_profiles),
+    ('aggregated_measures_to_amon', setup_aggregated_measures),
+    ('aggregated_measures_to_amon_deepcopy',
+     setup_aggregated_measures_deepcopy),
+    ('contract_to_amon', setup_contracts),
+    ('cups_20_config', setup_cups_20_config),
+    ('cups_20_getenv', setup_cups_20_getenv),
+    ('tariff_to_amon', setup_tariffs),
+    ('indexed_to_amon', setup_indexed),
+]
+
+
+def run_benchmark(name, setup, size, repeat=5, cold=False):
+    from amoniak.amon import AmonConverter
+    client, func = setup(size)
+    amon = AmonConverter(client)
+    # First run fills the caches of the process
+    func(amon)
+    timings = []
+    for _ in range(repeat):
+        if cold:
+            clear_caches()
+        client.reset_calls()
+        timings.append(timeit.timeit(lambda: func(amon), number=1))
+    return {
+        'name': name,
+        'size': size,
+        'repeat': repeat,
+        'cold': cold,
+        'best': min(timings),
+        'mean': sum(timings) / len(timings),
+        'per_item': min(timings) / size,
+        'erp_calls': client.calls_info()
+    }
+
+
+@click.command()
+@click.option('--sizes', default='100,1000,10000',
+              help='Comma separated number of items')
+@click.option('--repeat', default=5, type=click.INT)
+@click.option('--cold', default=False, is_flag=True,
+              help='Empty the process caches before every run')
+@click.option('--only', multiple=True, help='Benchmarks to run')
+@click.option('--output', type=click.File('w'), default='-')
+def main(sizes, repeat, cold, only, output):
+    use_fake_redis()
+    sizes = [int(size) for size in sizes.split(',')]
+    results = []
+    for name, setup in BENCHMARKS:
+        if only and name not in only:
+            continue
+        for size in sizes:
+            result = run_benchmark(name, setup, size, repeat, cold)
+            click.echo('{name} ({size}): {best:.4f}s best, '
+                       '{mean:.4f}s mean'.format(**result), err=True)
+            results.append(result)
+    json.dump({
+        'date': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
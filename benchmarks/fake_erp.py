@@ -0,0 +1,209 @@
+# -*- coding: utf-8 -*-
+"""In-memory ERP client with the parts of the erppeek API used by amoniak.
+"""
+from __future__ import absolute_import
+import fnmatch
+import re
+from collections import defaultdict
+
+
+def model_name(attr):
+    """``GiscedataCupsPs`` -> ``giscedata.cups.ps``"""
+    return re.sub(r'(?<!^)([A-Z])', r'.\1', attr).lower()
+
+
+class Ref(object):
+    """Many2one value stored in a fake record."""
+    __slots__ = ('model', 'id')
+
+    def __init__(self, model, id):
+        self.model = model
+        self.id = id
+
+
+def like(value, pattern):
+    return fnmatch.fnmatchcase(value or '', pattern.replace('%', '*'))
+
+
+OPERATORS = {
+    '=': lambda a, b: a == b,
+    '!=': lambda a, b: a != b,
+    '>': lambda a, b: a > b,
+    '>=': lambda a, b: a >= b,
+    '<': lambda a, b: a < b,
+    '<=': lambda a, b: a <= b,
+    'in': lambda a, b: a in b,
+    'not in': lambda a, b: a not in b,
+    '=like': like,
+    'like': lambda a, b: b in (a or ''),
+    'ilike': lambda a, b: b.lower() in (a or '').lower(),
+}
+
+
+class FakeRecord(object):
+    """Browse record, resolves the relations on attribute access."""
+
+    def __init__(self, model, id):
+        self._model = model
+        self.id = id
+
+    def __getattr__(self, name):
+        value = self._model.records[self.id][name]
+        client = self._model.client
+        if isinstance(value, Ref):
+            return client.model(value.model).browse(value.id)
+        if isinstance(value, list) and value and isinstance(value[0], Ref):
+            return [client.model(v.model).browse(v.id) for v in value]
+        return value
+
+
+class FakeModel(object):
+    def __init__(self, client, name):
+        self.client = client
+        self._name = name
+        self.records = {}
+        self.methods = {}
+
+    def __getattr__(self, name):
+        try:
+            method = self.methods[name]
+        except KeyError:
+            raise AttributeError(name)
+
+        def call(*args):
+            self.client.count(self._name, name)
+            return method(*args)
+        return call
+
+    def create(self, values):
+        new_id = len(self.records) + 1
+        self.records[new_id] = dict(values, id=new_id)
+        return new_id
+
+    def register(self, name, func):
+        """Add a custom server method (``get_potencies_dict``...)."""
+        self.methods[name] = func
+
+    def value(self, record, field):
+        value = record.get(field, False)
+        if isinstance(value, Ref):
+            target = self.client.model(value.model).records[value.id]
+            return [value.id, target.get('name', str(value.id))]
+        if isinstance(value, list) and value and isinstance(value[0], Ref):
+            return [v.id for v in value]
+        return value
+
+    def fields_get(self, *args):
+        self.client.count(self._name, 'fields_get')
+        fields = set()
+        for record in self.records.values():
+            fields.update(record)
+        return dict((f, {}) for f in fields)
+
+    def search_value(self, record, path):
+        """Value of a ``cups.name`` style path, relations as ids."""
+        value = record
+        for field in path.split('.'):
+            if isinstance(value, Ref):
+                value = self.client.model(value.model).records[value.id]
+            value = value and value.get(field, False)
+        if isinstance(value, Ref):
+            return value.id
+        if isinstance(value, list):
+            return [isinstance(v, Ref) and v.id or v for v in value]
+        return value
+
+    def match(self, record, domain):
+        """Evaluate a domain in prefix notation."""
+        stack = []
+        for term in reversed(domain or []):
+            if term == '|':
+                stack.append(stack.pop() | stack.pop())
+            elif term == '&':
+                stack.append(stack.pop() & stack.pop())
+            elif term == '!':
+                stack.append(not stack.pop())
+            else:
+                field, operator, expected = term
+                stack.append(bool(OPERATORS[operator](
+                    self.search_value(record, field), expected
+                )))
+        return all(stack)
+
+    def search(self, domain=None, offset=0, limit=None, order=None,
+               context=None):
+        self.client.count(self._name, 'search')
+        ids = [
+            record_id for record_id in sorted(self.records)
+            if self.match(self.records[record_id], domain)
+        ]
+        return ids[offset:limit and offset + limit or None]
+
+    def search_count(self, domain=None, context=None):
+        self.client.count(self._name, 'search_count')
+        return len([
+            r for r in self.records.values() if self.match(r, domain)
+        ])
+
+    def read(self, ids, fields=None, context=None):
+        self.client.count(self._name, 'read')
+        single = not isinstance(ids, (list, tuple))
+        rows = []
+        for record_id in single and [ids] or sorted(set(ids)):
+            record = self.records[record_id]
+            row = dict(
+                (f, self.value(record, f)) for f in fields or record
+            )
+            row['id'] = record_id
+            rows.append(row)
+        return single and rows[0] or rows
+
+    def write(self, ids, values, context=None):
+        self.client.count(self._name, 'write')
+        if not isinstance(ids, (list, tuple)):
+            ids = [ids]
+        for record_id in ids:
+            self.records[record_id].update(values)
+        return True
+
+    def browse(self, ids):
+        if isinstance(ids, (list, tuple)):
+            return [FakeRecord(self, i) for i in ids]
+        return FakeRecord(self, ids)
+
+
+class FakeClient(object):
+    """Fake ``erppeek.Client``.
+
+    Models are reached as attributes (``client.GiscedataPolissa``) or with
+    ``client.model('giscedata.polissa')``. Every call to the server is
+    counted in `calls` by (model, method).
+    """
+
+    def __init__(self):
+        self.models = {}
+        self.calls = defaultdict(int)
+
+    def model(self, name):
+        if name not in self.models:
+            self.models[name] = FakeModel(self, name)
+        return self.models[name]
+
+    def __getattr__(self, name):
+        if name.startswith('_'):
+            raise AttributeError(name)
+        if name[0].islower():
+            # irAttachment style
+            name = name[0].upper() + name[1:]
+        return self.model(model_name(name))
+
+    def count(self, model, method):
+        self.calls[(model, method)] += 1
+
+    def calls_info(self):
+        return dict(
+            ('{}.{}'.format(*key), value) for key, value in self.calls.items()
+        )
+
+    def reset_calls(self):
+        self.calls.clear()
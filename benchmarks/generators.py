@@ -0,0 +1,250 @@
+# -*- coding: utf-8 -*-
+"""Synthetic ERP data for the benchmarks.
+
+Every generator is deterministic for a given size, so the results of
+different runs can be compared.
+"""
+from __future__ import absolute_import
+import random
+from base64 import b64encode
+from datetime import datetime, timedelta
+
+from .fake_erp import FakeClient, Ref
+
+
+START = datetime(2015, 1, 1)
+TARIFFS = ['2.0A', '2.0DHA', '2.1A', '3.0A']
+PERIODS = ['P1', 'P2', 'P3', 'P4', 'P5', 'P6']
+
+
+def cups_name(idx):
+    return 'ES{:016d}AB0F'.format(idx)
+
+
+def make_profiles(size, meters=None):
+    """Hourly profiles (``name``, ``datetime``, ``ai``) of `meters` meters.
+    """
+    rand = random.Random(size)
+    meters = meters or max(1, size // (24 * 30))
+    profiles = []
+    for idx in range(size):
+        hour = START + timedelta(hours=idx // meters)
+        profiles.append({
+            'name': cups_name(idx % meters)[:20],
+            'datetime': hour.strftime('%Y-%m-%d %H:%M:%S'),
+            'ai': rand.randint(0, 3000)
+        })
+    return profiles
+
+
+def make_aggregated_measures(size):
+    """Aggregated measures as returned by ``get_aggregated_measures``.
+    """
+    rand = random.Random(size)
+    measures = []
+    for idx in range(size):
+        day = START + timedelta(days=idx % 365)
+        measures.append({
+            'cups': cups_name(idx),
+            'timestamp': day.strftime('%Y-%m-%d %H:%M:%S'),
+            'resource': idx % 5 and 'R' or 'T',
+            'measures': [
+                dict(
+                    [('tipus', tipus)] +
+                    [(p.lower(), rand.random() * 100) for p in PERIODS]
+                )
+                for tipus in ('A', 'R', 'P')
+            ]
+        })
+    return measures
+
+
+def make_reference_data(client):
+    """Tariffs, pricelist, municipality and the power uom reference.
+    """
+    tariffs = [
+        client.GiscedataPolissaTarifa.create({'name': name})
+        for name in TARIFFS
+    ]
+    currency = client.ResCurrency.create({'name': 'EUR'})
+    versions = []
+    for year in range(2013, 2016):
+        versions.append(Ref('product.pricelist.version', (
+            client.ProductPricelistVersion.create({
+                'date_start': '{}-01-01'.format(year),
+                'date_end': year < 2015 and '{}-12-31'.format(year) or False
+            })
+        )))
+    pricelist = client.ProductPricelist.create({
+        'name': 'TARIFAS ELECTRICIDAD',
+        'currency_id': Ref('res.currency', currency),
+        'version_id': versions,
+        'tarifes_atr_compatibles': [
+            Ref('giscedata.polissa.tarifa', t) for t in tariffs
+        ]
+    })
+    periodes = [
+        client.GiscedataPolissaTarifaPeriodes.create({'name': name})
+        for name in ['P1', 'P2']
+    ]
+    municipi = client.ResMunicipi.create({'name': 'Girona', 'ine': '17079'})
+    street = client.ResTipovia.create({'name': 'Carrer'})
+
+    def get_periodes_preus(tariff_id, tipus, pricelist_id, context=None):
+        return dict((p, 0.1 + idx / 100.0) for idx, p in enumerate(PERIODS))
+
+    client.GiscedataPolissaTarifa.register(
+        'get_periodes_preus', get_periodes_preus
+    )
+    client.IrModelData.register(
+        'get_object_reference', lambda module, name: ['product.uom', 1]
+    )
+    return {
+        'tariffs': tariffs,
+        'pricelist': pricelist,
+        'periodes': periodes,
+        'municipi': municipi,
+        'street': street
+    }
+
+
+def make_contracts(size, modcons=3, client=None):
+    """Create `size` active contracts with `modcons` modcons each.
+
+    Returns the client and the ids of the contracts.
+    """
+    client = client or FakeClient()
+    ref = make_reference_data(client)
+    rand = random.Random(size)
+    contract_ids = []
+    for idx in range(size):
+        partner = client.ResPartner.create({
+            'name': 'Partner {}'.format(idx), 'lang': 'ca_ES'
+        })
+        cups = client.GiscedataCupsPs.create({
+            'name': cups_name(idx),
+            'id_municipi': Ref('res.municipi', ref['municipi']),
+            'tv': Ref('res.tipovia', ref['street']),
+            'nv': 'Major', 'pnp': str(idx), 'es': '', 'pt': '1', 'pu': '2',
+            'cpo': '', 'cpa': '', 'dp': '17001', 'empowering': idx % 2
+        })
+        tariff = Ref(
+            'giscedata.polissa.tarifa', rand.choice(ref['tariffs'])
+        )
+        pricelist = Ref('product.pricelist', ref['pricelist'])
+        modcon_ids = []
+        for version in range(modcons):
+            start = START + timedelta(days=365 * version)
+            modcon_ids.append(Ref(
+                'giscedata.polissa.modcontractual',
+                client.GiscedataPolissaModcontractual.create({
+                    'name': str(version + 1),
+                    'data_inici': start.strftime('%Y-%m-%d'),
+                    'data_final': (
+                        start + timedelta(days=364)
+                    ).strftime('%Y-%m-%d'),
+                    'llista_preu': pricelist,
+                    'tarifa': tariff,
+                    'potencia': 3.3 + version,
+                    'mode_facturacio': 'atr',
+                    'coeficient_d': 0.0,
+                    'coeficient_k': 0.0
+                })
+            ))
+        comptador = client.GiscedataLecturesComptador.create({
+            'name': '{:09d}'.format(idx),
+            'data_alta': START.strftime('%Y-%m-%d'),
+            'data_baixa': False,
+            'empowering_last_measure': False
+        })
+        contract = client.GiscedataPolissa.create({
+            'name': '{:07d}'.format(idx),
+            'state': 'activa',
+            'contract_type': '01',
+            'etag': False,
+            'empowering_last_profile_measure': False,
+            'cups': Ref('giscedata.cups.ps', cups),
+            'titular': Ref('res.partner', partner),
+            'pagador': Ref('res.partner', partner),
+            'comptadors': [Ref('giscedata.lectures.comptador', comptador)],
+            'tarifa': tariff,
+            'llista_preu': pricelist,
+            'modcontractual_activa': modcon_ids[-1],
+            'modcontractuals_ids': modcon_ids,
+            'data_alta': START.strftime('%Y-%m-%d'),
+            'data_baixa': False,
+            'cnae': False,
+            'potencia': 3.3 + modcons - 1,
+            'coeficient_d': 0.0,
+            'coeficient_k': 0.0,
+            'mode_facturacio': 'atr',
+            # Half of the contracts use get_potencies_dict
+            'potencies_periode': [
+                Ref('giscedata.polissa.potencia.contractada.periode',
+                    client.GiscedataPolissaPotenciaContractadaPeriode.create({
+                        'periode_id': Ref(
+                            'giscedata.polissa.tarifa.periodes', periode
+                        ),
+                        'potencia': 3.3
+                    }))
+                for periode in ref['periodes'] if idx % 2
+            ]
+        })
+        client.GiscedataLecturesComptador.write(comptador, {
+            'polissa': Ref('giscedata.polissa', contract)
+        })
+        contract_ids.append(contract)
+
+    def get_potencies_dict(record_id):
+        return {'P1': 3.3, 'P2': 3.3}
+
+    client.GiscedataPolissa.register('get_potencies_dict', get_potencies_dict)
+    client.GiscedataPolissa.register(
+        'get_empowering_custom_fields', lambda record_id: {}
+    )
+    client.GiscedataPolissaModcontractual.register(
+        'get_potencies_dict', get_potencies_dict
+    )
+    client.reset_calls()
+    return client, contract_ids
+
+
+def make_price_attachments(size, hours=24 * 30, client=None):
+    """Create `size` invoices with a ``PH_`` hourly prices attachment.
+
+    Returns the client and the ids of the invoices.
+    """
+    client = client or FakeClient()
+    rand = random.Random(size)
+    invoice_ids = []
+    for idx in range(size):
+        invoice = client.GiscedataFacturacioFactura.create({
+            'name': 'F{:07d}'.format(idx)
+        })
+        lines = []
+        for hour in range(hours):
+            day = START + timedelta(days=hour // 24)
+            lines.append('{} {};{:.6f};0;'.format(
+                day.strftime('%Y-%m-%d'), hour % 24 + 1, rand.random() / 10
+            ))
+        client.IrAttachment.create({
+            'name': 'PH_{}'.format(idx),
+            'res_model': 'giscedata.facturacio.factura',
+            'res_id': invoice,
+            'datas': b64encode('\n'.join(lines))
+        })
+        invoice_ids.append(invoice)
+    client.reset_calls()
+    return client, invoice_ids
+
+
+def make_profile_records(size, collection='tg.cchfact', client=None):
+    """Create `size` profiles in `collection`.
+
+    Returns the client and the ids of the profiles.
+    """
+    client = client or FakeClient()
+    model = client.model(collection)
+    profile_ids = [model.create(p) for p in make_profiles(size)]
+    client.reset_calls()
+    return client, profile_ids
@@ -0,0 +1,322 @@
+# -*- coding: utf-8 -*-
+"""End to end benchmark: enqueue_* -> RQ -> push_* -> Empowering API.
+
+The ERP is the in-memory fake client, RQ runs on fakeredis and the
+Empowering API is a local HTTP server answering like Eve with a configurable
+latency.
+
+    $ python -m benchmarks.pipeline --size 1000 --latency 0.05 --output pipeline.json
+"""
+from __future__ import absolute_import
+import json
+import logging
+import platform
+import sys
+import threading
+import time
+from BaseHTTPServer import BaseHTTPRequestHandler, HTTPServer
+from collections import defaultdict
+from datetime import datetime, timedelta
+from hashlib import sha1
+from SocketServer import ThreadingMixIn
+from uuid import uuid4
+
+import click
+
+from .converters import use_fake_redis
+from .fake_erp import Ref
+from .generators import (
+    START, make_aggregated_measures, make_contracts, make_price_attachments,
+    make_profile_records
+)
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # Keeps the connections open as the real API
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        BaseHTTPRequestHandler.setup(self)
+        with self.server.lock:
+            self.server.stats['connections'] += 1
+
+    def send_json(self, data, code=200):
+        body = json.dumps(data)
+        self.send_response(code)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        return len(body)
+
+    def handle_request(self):
+        length = int(self.headers.getheader('content-length') or 0)
+        body = length and self.rfile.read(length) or ''
+        # /v1/<resource>[/<id>]
+        resource = self.path.split('?')[0].strip('/').split('/')[1]
+        time.sleep(self.server.latency)
+        documents = []
+        if self.command == 'GET':
+            response = {'_items': [], '_links': {}, '_meta': {'total': 0}}
+        else:
+            documents = json.loads(body or '{}')
+            if isinstance(documents, list):
+                response = {
+                    '_status': 'OK',
+                    '_items': [self.server.item() for _ in documents]
+                }
+            else:
+                response = self.server.item()
+                documents = [documents]
+        bytes_out = self.send_json(response)
+        self.server.record(
+            self.command, resource, length, bytes_out, documents
+        )
+
+    do_GET = do_POST = do_PUT = do_PATCH = handle_request
+
+    def log_message(self, *args):
+        pass
+
+
+class StubEmpowering(ThreadingMixIn, HTTPServer):
+    """Local Empowering API accepting every document.
+    """
+    daemon_threads = True
+
+    def __init__(self, latency=0.0):
+        HTTPServer.__init__(self, ('127.0.0.1', 0), StubHandler)
+        self.latency = latency
+        self.lock = threading.Lock()
+        self.reset()
+
+    @property
+    def url(self):
+        return 'http://{}:{}'.format(*self.server_address)
+
+    def item(self):
+        return {
+            '_status': 'OK',
+            '_id': uuid4().hex,
+            '_etag': sha1(uuid4().hex).hexdigest(),
+            '_updated': datetime.utcnow().strftime('%a, %d %b %Y %H:%M:%S GMT')
+        }
+
+    def reset(self):
+        self.stats = defaultdict(int)
+
+    def record(self, method, resource, bytes_in, bytes_out, documents):
+        with self.lock:
+            self.stats['requests'] += 1
+            self.stats['requests.{} {}'.format(method, resource)] += 1
+            self.stats['bytes_in'] += bytes_in
+            self.stats['bytes_out'] += bytes_out
+            self.stats['documents'] += len(documents)
+            self.stats['measurements'] += sum(
+                len(d.get('measurements', [])) for d in documents
+            )
+
+    def start(self):
+        thread = threading.Thread(target=self.serve_forever)
+        thread.daemon = True
+        thread.start()
+
+    def stop(self):
+        self.shutdown()
+        self.server_close()
+
+
+def with_etag(client, contract_ids, **values):
+    values.setdefault('etag', 'etag')
+    client.GiscedataPolissa.write(contract_ids, values)
+
+
+def scenario_profiles(size, bucket):
+    from amoniak import tasks
+    client, contract_ids = make_contracts(max(1, size // (24 * 30)))
+    with_etag(client, contract_ids,
+              empowering_last_profile_measure='2014-12-31 23:00:00')
+    make_profile_records(size, client=client)
+    client.model('tg.f1')
+    return client, lambda: tasks.enqueue_profiles(bucket, bulk=100)
+
+
+def scenario_measures(size, bucket):
+    from amoniak import tasks
+    meters = max(1, size // 365)
+    client, contract_ids = make_contracts(meters)
+    with_etag(client, contract_ids)
+    comptadors = client.GiscedataLecturesComptador
+
+    def get_aggregated_measures(ids, from_date):
+        comptador = comptadors.records[ids[0]]
+        cups = client.GiscedataPolissa.records[comptador['polissa'].id]['cups']
+        measures = make_aggregated_measures(size // meters)
+        for measure in measures:
+            measure['meter_id'] = ids[0]
+            measure['cups'] = client.GiscedataCupsPs.records[cups.id]['name']
+        return measures
+
+    comptadors.register('get_aggregated_measures', get_aggregated_measures)
+    comptadors.register(
+        'update_empowering_last_measure', lambda ids, timestamp: True
+    )
+    return client, lambda: tasks.enqueue_measures(bucket)
+
+
+def scenario_contracts(size, bucket):
+    from amoniak import tasks
+    client, _ = make_contracts(size)
+    return client, lambda: tasks.enqueue_contracts(force=True)
+
+
+def scenario_tariffs(size, bucket):
+    from amoniak import tasks
+    client, contract_ids = make_contracts(size)
+    with_etag(client, contract_ids)
+    return client, tasks.enqueue_tariffs
+
+
+def scenario_indexed(size, bucket):
+    from amoniak import tasks
+    client, contract_ids = make_contracts(max(1, size // 12))
+    pricelist = client.ProductPricelist.create({'name': 'Indexada'})
+    with_etag(client, contract_ids, mode_facturacio='index',
+              llista_preu=Ref('product.pricelist', pricelist))
+    client, invoice_ids = make_price_attachments(size, client=client)
+    for idx, invoice_id in enumerate(invoice_ids):
+        start = START + timedelta(days=30 * (idx // len(contract_ids)))
+        client.GiscedataFacturacioFactura.write(invoice_id, {
+            'polissa_id': Ref(
+                'giscedata.polissa', contract_ids[idx % len(contract_ids)]
+            ),
+            'type': 'out_invoice',
+            'llista_preu': Ref('product.pricelist', pricelist),
+            'data_inici': start.strftime('%Y-%m-%d'),
+            'data_final': (start + timedelta(days=29)).strftime('%Y-%m-%d')
+        })
+    client.reset_calls()
+    return client, tasks.enqueue_indexed
+
+
+SCENARIOS = [
+    ('profiles', scenario_profiles, ['profiles']),
+    ('measures', scenario_measures, ['measures']),
+    ('contracts', scenario_contracts, ['contracts']),
+    ('tariffs', scenario_tariffs, ['tariffs']),
+    ('indexed', scenario_indexed, ['indexeds']),
+]
+
+
+def setup_empowering(url):
+    from amoniak.executors import KeepAliveEmpowering
+    em = KeepAliveEmpowering(company_id=1)
+    em.apiroot = url
+    return em
+
+
+def run_scenario(name, setup, queue_names, size, bucket, server, conn):
+    from rq import Queue
+    from rq.job import Job
+    from rq.queue import FailedQueue
+    from amoniak import tasks
+    from amoniak.utils import reset_clients
+    from amoniak.worker import SimpleWorker
+    conn.flushall()
+    reset_clients()
+    client, enqueue = setup(size, bucket)
+    em = setup_empowering(server.url)
+    tasks.setup_peek = tasks.get_peek = lambda **kwargs: client
+    tasks.get_empowering_api = lambda **kwargs: em
+
+    server.reset()
+    start = time.time()
+    enqueue()
+    enqueue_time = time.time() - start
+    enqueue_calls = sum(client.calls.values())
+    queues = [Queue(q, connection=conn) for q in queue_names]
+    job_ids = [job_id for q in queues for job_id in q.job_ids]
+    jobs = len(job_ids)
+
+    client.reset_calls()
+    server.reset()
+    worker = SimpleWorker(queues, connection=conn)
+    start = time.time()
+    worker.work(burst=True)
+    work_time = time.time() - start
+    stats = dict(server.stats)
+    # Time spent in every phase of the jobs, from the jobs metrics
+    phases = defaultdict(float)
+    for job_id in job_ids:
+        metrics = Job.fetch(job_id, connection=conn).meta.get('metrics', {})
+        for phase_name, seconds in metrics.get('phases', {}).items():
+            phases[phase_name] += seconds
+    erp_calls = client.calls_info()
+    per_job = lambda value: jobs and float(value) / jobs or 0
+    per_second = lambda value: work_time and value / work_time or 0
+    return {
+        'name': name,
+        'size': size,
+        'bucket': bucket,
+        'latency': server.latency,
+        'jobs': jobs,
+        'failed_jobs': FailedQueue(connection=conn).count,
+        'enqueue_seconds': enqueue_time,
+        'enqueue_erp_calls': enqueue_calls,
+        'work_seconds': work_time,
+        'jobs_per_second': per_second(jobs),
+        'documents_per_second': per_second(stats.get('documents', 0)),
+        'measurements_per_second': per_second(stats.get('measurements', 0)),
+        'erp_calls_per_job': per_job(sum(erp_calls.values())),
+        'http_calls_per_job': per_job(stats.get('requests', 0)),
+        'http_connections': stats.get('connections', 0),
+        'phases_seconds': dict(phases),
+        'erp_calls': erp_calls,
+        'http': stats
+    }
+
+
+@click.command()
+@click.option('--size', default=1000, type=click.INT,
+              help='Number of profiles, measures, contracts... to push')
+@click.option('--bucket', default=500, type=click.INT)
+@click.option('--latency', default=0.0, type=click.FLOAT,
+              help='Seconds the stub API takes to answer every request')
+@click.option('--only', multiple=True, help='Scenarios to run')
+@click.option('--output', type=click.File('w'), default='-')
+def main(size, bucket, latency, only, output):
+    logging.basicConfig(level=logging.WARNING)
+    conn = use_fake_redis()
+    server = StubEmpowering(latency)
+    server.start()
+    results = []
+    try:
+        for name, setup, queue_names in SCENARIOS:
+            if only and name not in only:
+                continue
+            result = run_scenario(
+                name, setup, queue_names, size, bucket, server, conn
+            )
+            click.echo(
+                '{name}: {jobs} jobs ({failed_jobs} failed), '
+                '{jobs_per_second:.2f} jobs/s, '
+                '{measurements_per_second:.1f} measurements/s, '
+                '{erp_calls_per_job:.1f} ERP calls/job, '
+                '{http_calls_per_job:.1f} HTTP calls/job, '
+                '{http_connections} HTTP connections'.format(**result),
+                err=True
+            )
+            results.append(result)
+    finally:
+        server.stop()
+    json.dump({
+        'date': datetime.now().isoformat(),
+        'python': sys.version.split()[0],
+        'platform': platform.platform(),
+        'results': results
+    }, output, indent=2, sort_keys=True)
+    output.write('\n')
+
+
+if __name__ == '__main__':
+    main()
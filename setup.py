@@ -5,7 +5,6 @@ INSTALL_REQUIRES = [
     'erppeek',
     'pymongo<3',
     'rq',
-    'modeldict',
     'times',
     'raven',
     'click'